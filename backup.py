@@ -0,0 +1,129 @@
+"""Backups of the bot database.
+
+python backup.py snapshot DEST [--base PREVIOUS]  - take a snapshot of the running bot's database
+python backup.py verify SNAPSHOT                  - check a snapshot
+python backup.py restore SNAPSHOT DB_PATH         - restore a snapshot to a new database directory
+
+The database path for snapshot is taken from the config file unless --db is given.
+"""
+from typing import List
+from argparse import ArgumentParser
+from hashlib import sha256
+from shutil import copyfile
+from os import mkdir, makedirs, listdir
+from os.path import dirname
+from json import load
+from sys import exit
+import logging
+
+from data import BotDB, SharedBotDB, DBIndex, ArchiveIndex
+
+logger = logging.getLogger(__name__)
+
+CONFIG = "config.json"
+
+
+def _snapshot_report_ids(snapshot: str, files: dict) -> List[int]:
+    """IDs of reports in the index of a snapshot"""
+    index = DBIndex.read(f"{snapshot}/{BotDB.FILE_INDEX}") if BotDB.FILE_INDEX in files else DBIndex()
+    log_name = BotDB.FILE_INDEX_LOG.format(index.generation)
+    if log_name in files:
+        with open(f"{snapshot}/{log_name}", "rb") as fp:
+            index.replay(fp.read())
+    return index.catalog.ids.tolist()
+
+
+def verify_snapshot(snapshot: str) -> List[str]:
+    """Check files of a snapshot by their hashes and that indexes refer to existing files, returns problems"""
+    try:
+        with open(f"{snapshot}/{BotDB.FILE_MANIFEST}", "r") as fp:
+            manifest = load(fp)
+    except FileNotFoundError:
+        return [f"{BotDB.FILE_MANIFEST} is not found"]
+    if manifest["version"] > BotDB.SNAPSHOT_VERSION:
+        return [f"Unknown snapshot version {manifest['version']}"]
+    files = manifest["files"]
+    problems = []
+    for name, entry in files.items():
+        digest = sha256()
+        try:
+            with open(f"{snapshot}/{name}", "rb") as fp:
+                for chunk in iter(lambda: fp.read(1 << 16), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            problems.append(f"{name} is missing")
+            continue
+        if digest.hexdigest() != entry["sha256"]:
+            problems.append(f"{name} is damaged")
+    if problems:
+        # A damaged index can't be read
+        return problems
+    problems += [f"Report {id} is in the index but not in the snapshot"
+                 for id in _snapshot_report_ids(snapshot, files) if BotDB.FILE_REPORT.format(id) not in files]
+    if BotDB.FILE_ARCHIVE_INDEX in files:
+        with open(f"{snapshot}/{BotDB.FILE_ARCHIVE_INDEX}", "rb") as fp:
+            records = ArchiveIndex.records(fp.read())
+        problems += [f"Archive segment {segment} is not in the snapshot"
+                     for segment, _, _, _ in records
+                     if BotDB.FILE_ARCHIVE_SEGMENT.format(segment) not in files or
+                     BotDB.FILE_ARCHIVE_IDS.format(segment) not in files]
+    return problems
+
+
+def restore_snapshot(snapshot: str, db_path: str):
+    """Copy a verified snapshot to a new database directory"""
+    problems = verify_snapshot(snapshot)
+    if problems:
+        raise ValueError(f"The snapshot is broken: {problems[0]}")
+    try:
+        mkdir(db_path)
+    except FileExistsError:
+        if listdir(db_path):
+            raise FileExistsError(f"{db_path} is not empty")
+    with open(f"{snapshot}/{BotDB.FILE_MANIFEST}", "r") as fp:
+        files = load(fp)["files"]
+    # Files are copied, so the database doesn't share them with other snapshots
+    for name in files:
+        # Blobs are in a subdirectory
+        makedirs(dirname(f"{db_path}/{name}"), exist_ok=True)
+        copyfile(f"{snapshot}/{name}", f"{db_path}/{name}")
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    parser = ArgumentParser(description="Snapshots of the bot database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = commands.add_parser("snapshot", help="take a snapshot of the database")
+    snapshot_parser.add_argument("dest")
+    snapshot_parser.add_argument("--base", help="previous snapshot, unchanged files are linked from it")
+    snapshot_parser.add_argument("--db", help="database path, db_path from the config by default")
+    verify_parser = commands.add_parser("verify", help="verify a snapshot")
+    verify_parser.add_argument("snapshot")
+    restore_parser = commands.add_parser("restore", help="restore a snapshot to a new directory")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("db_path")
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        db_path = args.db
+        if db_path is None:
+            with open(CONFIG) as fp:
+                db_path = load(fp)["db_path"]
+        # The bot is another process, so the database is locked between processes
+        manifest = SharedBotDB(db_path).snapshot(args.dest, args.base)
+        logger.info(f"Saved {len(manifest['files'])} files to {args.dest}")
+    elif args.command == "verify":
+        problems = verify_snapshot(args.snapshot)
+        for problem in problems:
+            logger.error(problem)
+        if problems:
+            exit(1)
+        logger.info(f"{args.snapshot} is fine")
+    elif args.command == "restore":
+        restore_snapshot(args.snapshot, args.db_path)
+        logger.info(f"Restored {args.snapshot} to {args.db_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import backup
+import data
+import unittest
+import shutil
+import os
+import fcntl
+
+TEMPDIR = "/tmp/TestBackupDirectory"
+DB_PATH = f"{TEMPDIR}/db"
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class WritingDuringSnapshotDB(data.BotDB):
+    """Changes the database after the snapshot is pinned"""
+
+    def __init__(self, db_path, write):
+        super().__init__(db_path)
+        self.write = write
+
+    def _snapshot_file(self, *args):
+        if self.write is not None:
+            write, self.write = self.write, None
+            write(self)
+        return super()._snapshot_file(*args)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        os.mkdir(TEMPDIR)
+        self.db = data.BotDB(DB_PATH)
+        self.ids = [self.db.add_report(data.ReportType.OTHER, str(i)) for i in range(5)]
+        self.db.subscribe_user(1, "en")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_snapshot_and_restore(self):
+        self.db.mark_report_removed(self.ids[0])
+        self.db.archive_reports(0)
+        self.db.snapshot(f"{TEMPDIR}/s1")
+        self.assertListEqual(backup.verify_snapshot(f"{TEMPDIR}/s1"), [])
+        backup.restore_snapshot(f"{TEMPDIR}/s1", f"{TEMPDIR}/restored")
+        restored = data.BotDB(f"{TEMPDIR}/restored")
+        self.assertListEqual(restored.list_reports(), self.ids[1:])
+        self.assertEqual(restored.get_report(self.ids[0]).msg, "0")
+        self.assertDictEqual(restored.list_subscriber_segments(), {"en": [1]})
+        self.assertFalse(os.path.exists(f"{DB_PATH}/{data.BotDB.DIR_SNAPSHOT}"))
+
+    def test_blobs(self):
+        blob_id = self.db.put_blob(b"photo")
+        self.db.set_blob_file_id(blob_id, "AgAD")
+        self.db.snapshot(f"{TEMPDIR}/s1")
+        backup.restore_snapshot(f"{TEMPDIR}/s1", f"{TEMPDIR}/restored")
+        restored = data.BotDB(f"{TEMPDIR}/restored")
+        with restored.open_blob(blob_id) as fp:
+            self.assertEqual(fp.read(), b"photo")
+        self.assertEqual(restored.get_blob_file_id(blob_id), "AgAD")
+
+    def test_point_in_time(self):
+        def write(db):
+            db.add_report(data.ReportType.OTHER, "new")
+            db.mark_report_seen(self.ids[1])
+            db.mark_report_removed(self.ids[2])
+            db.archive_reports(0)
+            db.subscribe_user(2, "ru")
+
+        db = WritingDuringSnapshotDB(DB_PATH, write)
+        db.snapshot(f"{TEMPDIR}/s1")
+        self.assertEqual(len(db.list_reports()), 4)
+        backup.restore_snapshot(f"{TEMPDIR}/s1", f"{TEMPDIR}/restored")
+        restored = data.BotDB(f"{TEMPDIR}/restored")
+        self.assertListEqual(restored.list_reports(), self.ids)
+        self.assertListEqual(restored.list_seen_reports(), [])
+        self.assertEqual(restored.get_report(self.ids[2]).msg, "2")
+        self.assertDictEqual(restored.list_subscriber_segments(), {"en": [1]})
+
+    def test_incremental(self):
+        self.db._compact()
+        self.db.snapshot(f"{TEMPDIR}/s1")
+        self.db.mark_report_seen(self.ids[0])
+        manifest = self.db.snapshot(f"{TEMPDIR}/s2", base=f"{TEMPDIR}/s1")
+        # The index, 5 reports and the log of changes after compaction
+        self.assertEqual(len(manifest["files"]), 7)
+
+        def same_file(name):
+            return os.stat(f"{TEMPDIR}/s1/{name}").st_ino == os.stat(f"{TEMPDIR}/s2/{name}").st_ino
+
+        self.assertTrue(same_file(data.BotDB.FILE_REPORT.format(self.ids[1])))
+        self.assertTrue(same_file(data.BotDB.FILE_INDEX))
+        self.assertFalse(same_file(data.BotDB.FILE_REPORT.format(self.ids[0])))
+        backup.restore_snapshot(f"{TEMPDIR}/s2", f"{TEMPDIR}/restored")
+        self.assertListEqual(data.BotDB(f"{TEMPDIR}/restored").list_seen_reports(), [self.ids[0]])
+        self.assertListEqual(backup.verify_snapshot(f"{TEMPDIR}/s2"), [])
+
+    def test_verify_damaged(self):
+        self.db.snapshot(f"{TEMPDIR}/s1")
+        with open(f"{TEMPDIR}/s1/{data.BotDB.FILE_REPORT.format(self.ids[3])}", "w") as fp:
+            fp.write("{}")
+        os.remove(f"{TEMPDIR}/s1/{data.BotDB.FILE_REPORT.format(self.ids[4])}")
+        self.assertEqual(len(backup.verify_snapshot(f"{TEMPDIR}/s1")), 2)
+        self.assertRaises(ValueError, backup.restore_snapshot, f"{TEMPDIR}/s1", f"{TEMPDIR}/restored")
+
+    def test_one_snapshot_at_once(self):
+        os.mkdir(f"{DB_PATH}/{data.BotDB.DIR_SNAPSHOT}")
+        # A running snapshot keeps its pin locked
+        with open(f"{DB_PATH}/{data.BotDB.DIR_SNAPSHOT}/{data.BotDB.FILE_SNAPSHOT_PIN}", "w") as pin:
+            fcntl.flock(pin, fcntl.LOCK_EX)
+            self.assertRaises(RuntimeError, self.db.snapshot, f"{TEMPDIR}/s1")
+
+    def test_failed_snapshot(self):
+        snapshot_dir = f"{DB_PATH}/{data.BotDB.DIR_SNAPSHOT}"
+        os.mkdir(snapshot_dir)
+        # The pin of a crashed snapshot is not locked by anyone
+        with open(f"{snapshot_dir}/{data.BotDB.FILE_SNAPSHOT_PIN}", "w") as pin:
+            pin.write('{"pid": 0, "started": 0}')
+        with self.assertLogs(data.logger, "WARNING"):
+            self.db.mark_report_seen(self.ids[0])
+        # Old versions of files are not kept for it
+        self.assertFalse(os.path.exists(snapshot_dir))
+        os.mkdir(snapshot_dir)
+        self.db.snapshot(f"{TEMPDIR}/s1")
+        self.assertListEqual(backup.verify_snapshot(f"{TEMPDIR}/s1"), [])
+        self.assertFalse(os.path.exists(snapshot_dir))
@@ -1,11 +1,14 @@
 from typing import Dict, Callable, Union, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from sys import exit
+from time import perf_counter
 import threading
 import logging
 import telegram as tg
 import telegram.ext as tgext
 
 from data import *
+from sender import OutboundScheduler, TokenBucket, INTERACTIVE, ADMIN, BROADCAST
 import translation
 
 # Translation function
@@ -15,6 +18,12 @@ S: Callable[[Union[str, tg.Update, tg.Message, tg.User], str], str]
 VERSION = "Anti-COVID-19 Bot for Kazakhstan v1.0"
 TRANSLATIONS_DIRECTORY = "languages"
 CONFIG = "config.json"
+# Telegram allows bots to send about 30 messages per second
+DEFAULT_SEND_RATE = 30
+# Seen reports older than this many days are moved to the archive
+DEFAULT_ARCHIVE_AFTER_DAYS = 30
+# Seconds between archiving runs
+DEFAULT_ARCHIVE_INTERVAL = 3600
 
 # Logging configuration
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -27,6 +36,9 @@ db: BotDB
 # Bot config dictionary
 config: Dict
 
+# All messages are sent through the scheduler
+scheduler: OutboundScheduler
+
 # States for several conversations
 SELECT_SERVICE, CHECK_SYMPTOMS, SELECT_REPORT_TYPE, WRITE_REPORT, CONFIRM_REPORT = range(5)
 AP_SELECT, SUBMIT_NEWS_POST, CONFIRM_SUBMITTING, REPORT_VIEWER, CONFIRM_REMOVING = range(5)
@@ -35,23 +47,56 @@ AP_SELECT, SUBMIT_NEWS_POST, CONFIRM_SUBMITTING, REPORT_VIEWER, CONFIRM_REMOVING
 # News Post object
 class NewsPost:
     def __init__(self):
-        self.texts = []
-        self.photos = []
-        self.videos = []
+        # Texts for subscribers whose language has no variant
+        self.texts: List[str] = []
+        # Photos and videos in the blob store, they are the same for all languages
+        self.attachments: List[Attachment] = []
+        # Attachments which are being downloaded yet
+        self.pending_attachments: List[Future] = []
+        # Language code -> texts written specially for this language
+        self.variants: Dict[str, List[str]] = {}
+        # Language of the texts the admin is writing now, None means default texts
+        self.editing_language: Optional[str] = None
+        # If set, only subscribers of these languages receive the post
+        self.target_languages: Optional[List[str]] = None
+
+    def add_text(self, text: str):
+        """Add a text to the language that is being edited"""
+        if self.editing_language is None:
+            self.texts.append(text)
+        else:
+            self.variants.setdefault(self.editing_language, []).append(text)
+
+    def texts_for(self, lang: str) -> List[str]:
+        """Get texts for a language segment, e.g. "en-US" falls back to "en" and then to default texts"""
+        if lang in self.variants:
+            return self.variants[lang]
+        return self.variants.get(lang.split("-")[0], self.texts)
+
+    def is_targeted(self, lang: str) -> bool:
+        """Whether the segment of this language should receive the post, "en-US" is targeted by "en" too"""
+        return self.target_languages is None or lang in self.target_languages or \
+            lang.split("-")[0] in self.target_languages
 
 
 # Users can select their reports' types, they're gonna stay here for a while
 report_types: Dict[int, int] = {}
 report_texts: Dict[int, str] = {}
+report_attachments: Dict[int, List[Future]] = {}
 news_posts: Dict[int, NewsPost] = {}
 
+# Photos and videos are downloaded here, so other updates don't wait for them
+downloader = ThreadPoolExecutor(4, thread_name_prefix="downloader")
+# Confirmed reports wait for their attachments here, the dispatcher isn't started in the cluster
+report_writer = ThreadPoolExecutor(2, thread_name_prefix="report_writer")
+
 # Lock for publishing news
 publication_lock = threading.Event()
 publication_lock.set()
 publication_queue: List[NewsPost] = []
 
-# Used when an admin watches reports
-viewing_status: Dict[int, int] = {}
+# Used when an admin watches reports, None means archived reports
+viewing_status: Dict[int, Optional[int]] = {}
 # Last report that was shown
 viewed_report_id: Dict[int, int] = {}
 # Action is about marking reports - giving them new statuses
@@ -60,13 +105,8 @@ viewed_report_id: Dict[int, int] = {}
 action_queue: List[Tuple[int, int]]
 
 
-def main():
-    # Manage languages
-    global S
-    tr = translation.BotTranslation(TRANSLATIONS_DIRECTORY)
-    S = tr.get_string
-
-    # Load the config file
+def load_config():
+    """Load the config file"""
     global config
     try:
         with open(CONFIG) as fp:
@@ -74,6 +114,21 @@ def main():
     except FileNotFoundError:
         logger.error(f"The configuration file {CONFIG} does not exist!")
         exit(1)
+    if "tg_key" not in config:
+        logger.error(f"Telegram key is not set!")
+        exit(1)
+
+
+def init(shared_db: bool = False, send_bucket: Optional[TokenBucket] = None, broadcast_reserve: float = 0):
+    """Initialize translations and the database, shared_db is needed when several processes use the database.
+
+    send_bucket is the limit of messages shared with other processes, see OutboundScheduler.
+    """
+    started = perf_counter()
+    # Manage languages
+    global S
+    tr = translation.BotTranslation(TRANSLATIONS_DIRECTORY)
+    S = tr.get_string
 
     # Initialize database class
     global db
@@ -81,17 +136,35 @@ def main():
         logger.error(f"Database path is not set!")
         exit(1)
     db_path = config["db_path"]
-    db = BotDB(db_path)
+    db = SharedBotDB(db_path) if shared_db else BotDB(db_path)
+    reports = db.load()
+    logger.info(f"Started in {perf_counter() - started:.3f} s with {reports} reports")
+
+    # send_rate is the limit of messages per second for the whole bot
+    global scheduler
+    scheduler = OutboundScheduler(rate=config.get("send_rate", DEFAULT_SEND_RATE),
+                                  bucket=send_bucket, broadcast_reserve=broadcast_reserve)
 
-    # Initialize the bot
-    if "tg_key" not in config:
-        logger.error(f"Telegram key is not set!")
-        exit(1)
-    tg_key = config["tg_key"]
-    bot = tgext.Updater(tg_key, use_context=True)
 
-    # Add all handlers
-    [bot.dispatcher.add_handler(handler) for handler in [
+def main():
+    load_config()
+    # backup.py can take snapshots of the database from another process
+    init(shared_db=True)
+
+    # Initialize the bot, tg_base_url allows to use another Bot API server
+    bot = tgext.Updater(config["tg_key"], base_url=config.get("tg_base_url"), use_context=True)
+    add_handlers(bot.dispatcher)
+    schedule_archiving(bot.job_queue)
+
+    # Long poll
+    logger.info(f"Launching {VERSION}")
+    bot.start_polling()
+    bot.idle()
+
+
+def add_handlers(dispatcher: tgext.Dispatcher):
+    """Add all handlers of the bot to a dispatcher"""
+    [dispatcher.add_handler(handler) for handler in [
         tgext.ConversationHandler(
             entry_points=[
                 tgext.CommandHandler("admin", cmd_admin)
@@ -103,9 +176,11 @@ def main():
                 SUBMIT_NEWS_POST: [
                     tgext.CommandHandler("finish", cmd_admin_finish),
                     tgext.CommandHandler("cancel", cmd_admin_cancel),
+                    tgext.CommandHandler("language", cmd_admin_language),
+                    tgext.CommandHandler("only", cmd_admin_only),
                     # TODO: Divide MessageHandlers by filters
                     tgext.MessageHandler(
-                        tgext.Filters.text,  # | tgext.Filters.photo | tgext.Filters.video,
+                        tgext.Filters.text | tgext.Filters.photo | tgext.Filters.video,
                         msg_submit_post
                     )
                 ],
@@ -138,10 +213,14 @@ def main():
                 ],
                 WRITE_REPORT: [
                     tgext.CommandHandler("cancel", cmd_write_report_cancel),
-                    tgext.MessageHandler(tgext.Filters.text, msg_write_report)
+                    tgext.MessageHandler(
+                        tgext.Filters.text | tgext.Filters.photo | tgext.Filters.video,
+                        msg_write_report
+                    )
                 ],
                 CONFIRM_REPORT: [
                     tgext.MessageHandler(tgext.Filters.text, msg_confirm_report),
+                    tgext.MessageHandler(tgext.Filters.photo | tgext.Filters.video, msg_add_report_attachment)
                 ]
             },
             fallbacks=[
@@ -149,10 +228,16 @@ def main():
         )
     ]]
 
-    # Long poll
-    logger.info(f"Launching {VERSION}")
-    bot.start_polling()
-    bot.idle()
+
+def schedule_archiving(job_queue: tgext.JobQueue):
+    """Archive old reports in the background, archive_after_days and archive_interval are set in the config"""
+    job_queue.run_repeating(archive_reports, config.get("archive_interval", DEFAULT_ARCHIVE_INTERVAL), first=60)
+
+
+def archive_reports(context: tgext.CallbackContext):
+    archived = db.archive_reports(config.get("archive_after_days", DEFAULT_ARCHIVE_AFTER_DAYS) * 24 * 3600)
+    if archived > 0:
+        logger.info(f"{archived} reports were archived")
 
 
 def extract_update(update: tg.Update):
@@ -161,6 +246,61 @@ def extract_update(update: tg.Update):
     return msg.from_user.id, msg.from_user.language_code, msg.text
 
 
+def reply(m: tg.Message, text: str, priority: int = INTERACTIVE, **kwargs) -> Future:
+    """Reply to a message through the scheduler"""
+    return scheduler.submit(priority, m.chat_id, m.reply_text, text, **kwargs)
+
+
+def admin_reply(m: tg.Message, text: str, **kwargs) -> Future:
+    """Reply to an admin, these replies go after users' replies but before broadcasts"""
+    return reply(m, text, priority=ADMIN, **kwargs)
+
+
+def store_attachment(m: tg.Message) -> Optional[Future]:
+    """Start saving a photo or a video of a message to the blob store, returns None if the message has neither.
+
+    The Future gets the Attachment or tg.error.TelegramError if the file can't be downloaded,
+    e.g. it's too big for bots. Files received before are not downloaded again.
+    """
+    if m.photo:
+        # The biggest size of the photo
+        type, media = AttachmentType.PHOTO, m.photo[-1]
+    elif m.video:
+        type, media = AttachmentType.VIDEO, m.video
+    else:
+        return None
+    blob_id = db.get_blob_by_unique_id(media.file_unique_id)
+    if blob_id is not None:
+        future = Future()
+        future.set_result((type, blob_id))
+        return future
+    return downloader.submit(download_attachment, type, media)
+
+
+def download_attachment(type: AttachmentType, media: Union[tg.PhotoSize, tg.Video]) -> Attachment:
+    blob_id = db.put_blob(bytes(media.get_file().download_as_bytearray()))
+    # The file is on Telegram servers already, so sending it never uploads it again
+    db.set_blob_file_id(blob_id, media.file_id, media.file_unique_id)
+    return type, blob_id
+
+
+def send_attachment(bot: tg.Bot, chat_id: int, attachment: Attachment, **kwargs) -> tg.Message:
+    """Send a stored photo or video, it's uploaded only if its file_id is unknown"""
+    type, blob_id = attachment
+    send = bot.send_photo if type == AttachmentType.PHOTO else bot.send_video
+    file_id = db.get_blob_file_id(blob_id)
+    if file_id is not None:
+        try:
+            return send(chat_id, file_id, **kwargs)
+        except tg.error.BadRequest as e:
+            # file_ids are valid only for the bot that got them, e.g. the database was moved to another bot
+            logger.warning(f"Cached file_id of blob {blob_id} is not accepted: {e}")
+    with db.open_blob(blob_id) as fp:
+        message = send(chat_id, fp, **kwargs)
+    db.set_blob_file_id(blob_id, message.photo[-1].file_id if message.photo else message.video.file_id)
+    return message
+
+
 def start_reply_keyboard(id, lang):
     sub_button_string = S(lang, "BUTTON_SUBSCRIBE_FOR_THE_NEWS") \
         if not db.is_user_subscribed(id) else S(lang, "BUTTON_UNSUBSCRIBE")
@@ -174,8 +314,8 @@ def start_reply_keyboard(id, lang):
 
 def cmd_start(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
-    m.reply_text(
-        S(m, "START"),
+    reply(
+        m, S(m, "START"),
         reply_markup=start_reply_keyboard(m.from_user.id, m)
     )
     return SELECT_SERVICE
@@ -185,43 +325,43 @@ def msg_select_service(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
     if text == S(lang, "BUTTON_BASIC_PROTECTION"):
-        m.reply_text(S(lang, "BASIC_PROTECTION_START"))
+        reply(m, S(lang, "BASIC_PROTECTION_START"))
     elif text == S(lang, "BUTTON_SUBSCRIBE_FOR_THE_NEWS"):
-        db.subscribe_user(id)
+        db.subscribe_user(id, lang)
         logger.info(f"User {id} has subscribed to the news")
-        m.reply_text(S(lang, "SUBSCRIBE_SUCCESS"),
-                     reply_markup=start_reply_keyboard(id, lang))
+        reply(m, S(lang, "SUBSCRIBE_SUCCESS"),
+              reply_markup=start_reply_keyboard(id, lang))
     elif text == S(lang, "BUTTON_UNSUBSCRIBE"):
         db.unsubscribe_user(id)
         logger.info(f"User {id} has unsubscribed from the news")
-        m.reply_text(S(lang, "UNSUBSCRIBE_SUCCESS"),
-                     reply_markup=start_reply_keyboard(id, lang))
+        reply(m, S(lang, "UNSUBSCRIBE_SUCCESS"),
+              reply_markup=start_reply_keyboard(id, lang))
     elif text == S(lang, "BUTTON_CHECK_SYMPTOMS"):
-        m.reply_text(S(lang, "BASIC_SYMPTOMS"),
-                     reply_markup=tg.ReplyKeyboardMarkup(
-                         [["✅", "❌"]], resize_keyboard=True, selective=True
-                     ))
+        reply(m, S(lang, "BASIC_SYMPTOMS"),
+              reply_markup=tg.ReplyKeyboardMarkup(
+                  [["✅", "❌"]], resize_keyboard=True, selective=True
+              ))
         return CHECK_SYMPTOMS
     elif text == S(lang, "BUTTON_WRITE_REPORT"):
-        m.reply_text(S(lang, "SELECT_REPORT_TYPE"),
-                     reply_markup=tg.ReplyKeyboardMarkup(
-                         [[S(lang, "TYPE_OVERPRICE")], [S(lang, "TYPE_OTHER")]],
-                         resize_keyboard=True, selective=True
-                     ))
+        reply(m, S(lang, "SELECT_REPORT_TYPE"),
+              reply_markup=tg.ReplyKeyboardMarkup(
+                  [[S(lang, "TYPE_OVERPRICE")], [S(lang, "TYPE_OTHER")]],
+                  resize_keyboard=True, selective=True
+              ))
         return SELECT_REPORT_TYPE
     else:
         # The language of the user could have changed
         # this is why we need to send the keyboard again
-        m.reply_text(S(lang, "UNKNOWN_SELECTION"),
-                     reply_markup=start_reply_keyboard(id, lang))
+        reply(m, S(lang, "UNKNOWN_SELECTION"),
+              reply_markup=start_reply_keyboard(id, lang))
 
 
 def msg_check_symptoms(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
     reply_keyboard = start_reply_keyboard(id, lang)
-    m.reply_text(S(lang, "WARNING" if text == "✅" else "NO_WARNING"),
-                 reply_markup=reply_keyboard)
+    reply(m, S(lang, "WARNING" if text == "✅" else "NO_WARNING"),
+          reply_markup=reply_keyboard)
     return SELECT_SERVICE
 
 
@@ -233,50 +373,86 @@ def msg_select_report_type(update: tg.Update, context: tgext.CallbackContext):
     else:
         type = ReportType.OTHER
     report_types[id] = type
-    m.reply_text(S(lang, "WRITE_YOUR_REPORT"),
-                 reply_markup=tg.ReplyKeyboardRemove(selective=True))
+    reply(m, S(lang, "WRITE_YOUR_REPORT"),
+          reply_markup=tg.ReplyKeyboardRemove(selective=True))
     return WRITE_REPORT
 
 
+def confirm_report_keyboard():
+    return tg.ReplyKeyboardMarkup([["✅", "❌"]], resize_keyboard=True, selective=True)
+
+
 def msg_write_report(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
+    # Photos and videos can have a caption instead of a text
+    text = text or m.caption or ""
+    attachment = store_attachment(m)
     report_texts[id] = text
-    m.reply_text(S(lang, "CONFIRM_SEND").format(text),
-                 reply_markup=tg.ReplyKeyboardMarkup(
-                     [["✅", "❌"]], resize_keyboard=True, selective=True
-                 ))
+    report_attachments[id] = [attachment] if attachment is not None else []
+    reply(m, S(lang, "CONFIRM_SEND").format(text), reply_markup=confirm_report_keyboard())
 
     return CONFIRM_REPORT
 
 
+def msg_add_report_attachment(update: tg.Update, context: tgext.CallbackContext):
+    """Photos and videos sent before the confirmation are added to the report"""
+    m = update.message
+    id, lang, text = extract_update(update)
+    if id not in report_texts:
+        reply(m, S(lang, "UNKNOWN_ERROR"))
+        return cmd_start(update, context)
+    if m.caption:
+        report_texts[id] = f"{report_texts[id]}\n{m.caption}" if report_texts[id] else m.caption
+    report_attachments[id].append(store_attachment(m))
+    reply(m, S(lang, "ATTACHMENTS_ADDED").format(len(report_attachments[id])),
+          reply_markup=confirm_report_keyboard())
+    return CONFIRM_REPORT
+
+
 def msg_confirm_report(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
     try:
         type = report_types[id]
         msg = report_texts[id]
+        attachments = report_attachments[id]
     except KeyError:
-        m.reply_text(S(lang, "UNKNOWN_ERROR"))
+        reply(m, S(lang, "UNKNOWN_ERROR"))
         return cmd_start(update, context)
     if text == "✅":
-        report_id = db.add_report(type, msg)
-        logger.info(f"A user wrote a report with ID {report_id}")
-        m.reply_text(S(lang, "THANK_YOU_FOR_REPORT"),
-                     reply_markup=start_reply_keyboard(id, lang))
+        # The report is written when its attachments are downloaded
+        report_writer.submit(save_report, m, lang, type, msg, attachments)
         del report_types[id]
         del report_texts[id]
+        del report_attachments[id]
     else:
-        m.reply_text(S(lang, "REPORTING_CANCELLED"),
-                     reply_markup=start_reply_keyboard(id, lang))
+        reply(m, S(lang, "REPORTING_CANCELLED"),
+              reply_markup=start_reply_keyboard(id, lang))
     return SELECT_SERVICE
 
 
+def save_report(m: tg.Message, lang, type: ReportType, msg: str, attachments: List[Future]):
+    """Save a report with its downloaded attachments, files which failed to download are skipped"""
+    saved = []
+    for future in attachments:
+        try:
+            saved.append(future.result())
+        except tg.error.TelegramError as e:
+            logger.warning(f"An attachment of a report can't be saved: {e}")
+    report_id = db.add_report(type, msg, saved)
+    logger.info(f"A user wrote a report with ID {report_id}")
+    reply_keyboard = start_reply_keyboard(m.from_user.id, lang)
+    if len(saved) < len(attachments):
+        reply(m, S(lang, "ATTACHMENT_ERROR"), reply_markup=reply_keyboard)
+    reply(m, S(lang, "THANK_YOU_FOR_REPORT"), reply_markup=reply_keyboard)
+
+
 def cmd_write_report_cancel(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
-    m.reply_text(S(lang, "REPORTING_CANCELLED"),
-                 reply_markup=start_reply_keyboard(id, lang))
+    reply(m, S(lang, "REPORTING_CANCELLED"),
+          reply_markup=start_reply_keyboard(id, lang))
     return SELECT_SERVICE
 
 
@@ -285,6 +461,7 @@ def admin_panel_keyboard(id: int, lang):
         [S(lang, "BUTTON_SEND_NEWS")],
         [S(lang, "BUTTON_UNSEEN")],
         [S(lang, "BUTTON_SEEN")],
+        [S(lang, "BUTTON_ARCHIVED")],
     ]
     return tg.ReplyKeyboardMarkup(
         raw_markup,
@@ -297,63 +474,79 @@ def cmd_admin(update: tg.Update, context: tgext.CallbackContext):
     id, lang, text = extract_update(update)
     is_admin = id in config["admins"]
     if not is_admin:
-        m.reply_text(S(lang, "ADMIN_MENU_PRIV_ERROR"))
+        reply(m, S(lang, "ADMIN_MENU_PRIV_ERROR"))
         return tgext.ConversationHandler.END
     else:
-        m.reply_text(S(lang, "ADMIN_PANEL_START"),
-                     reply_markup=admin_panel_keyboard(id, lang))
+        admin_reply(m, S(lang, "ADMIN_PANEL_START"),
+                    reply_markup=admin_panel_keyboard(id, lang))
     return AP_SELECT
 
 
-def show_report(context: tgext.CallbackContext, admin_id: int, lang, report_id: int):
-    """Send a report to an admin"""
+def show_report(context: tgext.CallbackContext, admin_id: int, lang, report_id: int, archived: bool = False):
+    """Send a report to an admin, archived reports can only be read"""
     bot = context.bot
     try:
         report = db.get_report(report_id)
+        # The message is loaded only here, it can be removed already too
+        send_text = S(lang, "REPORT_HEADER_TEMPLATE").format(report_id, report.type) + '\n' + report.msg
+        attachments = report.attachments
     except KeyError:
         # get_report can report KeyError if the report does not exist
         # that can happen when another admin deletes the selected report already
-        bot.send_message(admin_id, S(lang, "REPORT_IS_REMOVED"))
+        scheduler.submit(ADMIN, admin_id, bot.send_message, admin_id, S(lang, "REPORT_IS_REMOVED"))
         return
-    send_text = S(lang, "REPORT_HEADER_TEMPLATE").format(report_id, report.type) + '\n' + report.msg
-    bot.send_message(
-        admin_id, send_text,
-        reply_markup=tg.ReplyKeyboardMarkup(
-            [["⬅️",
-              S(lang, "MARK_SEEN") if report.status == ReportStatus.UNSEEN else S(lang, "MARK_UNSEEN"),
-              S(lang, "REMOVE_REPORT"),
-              S(lang, "QUIT_VIEWING"),
-              "➡️"]],
-            resize_keyboard=True, selective=True
-        )
+    if archived:
+        buttons = ["⬅️", S(lang, "QUIT_VIEWING"), "➡️"]
+    else:
+        buttons = ["⬅️",
+                   S(lang, "MARK_SEEN") if report.status == ReportStatus.UNSEEN else S(lang, "MARK_UNSEEN"),
+                   S(lang, "REMOVE_REPORT"),
+                   S(lang, "QUIT_VIEWING"),
+                   "➡️"]
+    scheduler.submit(
+        ADMIN, admin_id, bot.send_message, admin_id, send_text,
+        reply_markup=tg.ReplyKeyboardMarkup([buttons], resize_keyboard=True, selective=True)
     )
+    # Jobs of one chat keep their order, so attachments go after the text
+    for attachment in attachments:
+        scheduler.submit(ADMIN, admin_id, send_attachment, bot, admin_id, attachment)
 
 
 def msg_ap_select(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
     if text == S(lang, "BUTTON_SEND_NEWS"):
-        m.reply_text(S(lang, "SUBMIT_NEWS_1"), reply_markup=tg.ReplyKeyboardRemove())
+        admin_reply(m, S(lang, "SUBMIT_NEWS_1"), reply_markup=tg.ReplyKeyboardRemove())
         return SUBMIT_NEWS_POST
     elif text == S(lang, "BUTTON_UNSEEN"):
         viewing_status[id] = ReportStatus.UNSEEN
-        reports = db.list_unseen_reports()
-        if len(reports) > 0:
-            viewed_report_id[id] = reports[-1]
+        report_id = db.last_report(ReportStatus.UNSEEN)
+        if report_id is not None:
+            viewed_report_id[id] = report_id
             show_report(context, id, lang, viewed_report_id[id])
             return REPORT_VIEWER
         else:
-            m.reply_text(S(lang, "ERROR_NO_REPORTS_OF_THIS_TYPE"))
+            admin_reply(m, S(lang, "ERROR_NO_REPORTS_OF_THIS_TYPE"))
             return
     elif text == S(lang, "BUTTON_SEEN"):
         viewing_status[id] = ReportStatus.SEEN
-        reports = db.list_seen_reports()
-        if len(reports) > 0:
-            viewed_report_id[id] = reports[-1]
+        report_id = db.last_report(ReportStatus.SEEN)
+        if report_id is not None:
+            viewed_report_id[id] = report_id
             show_report(context, id, lang, viewed_report_id[id])
             return REPORT_VIEWER
         else:
-            m.reply_text(S(lang, "ERROR_NO_REPORTS_OF_THIS_TYPE"))
+            admin_reply(m, S(lang, "ERROR_NO_REPORTS_OF_THIS_TYPE"))
+            return
+    elif text == S(lang, "BUTTON_ARCHIVED"):
+        viewing_status[id] = None
+        report_id = db.last_archived_report()
+        if report_id is not None:
+            viewed_report_id[id] = report_id
+            show_report(context, id, lang, viewed_report_id[id], archived=True)
+            return REPORT_VIEWER
+        else:
+            admin_reply(m, S(lang, "ERROR_NO_REPORTS_OF_THIS_TYPE"))
             return
 
 
@@ -362,47 +555,73 @@ def msg_submit_post(update: tg.Update, context: tgext.CallbackContext):
     id, lang = m.from_user.id, m.from_user.language_code
     if id not in news_posts:
         news_posts[id] = NewsPost()
-    try:
-        if type(m.text) is str and m.text:
-            news_posts[id].texts.append(m.text)
-    except:
-        pass
-    try:
-        if len(m.photo) > 0:
-            news_posts[id].photos.append(m.photo)
-    except:
-        pass
-    try:
-        if len(m.video) > 0:
-            news_posts[id].videos.append(m.video)
-    except:
-        pass
-    m.reply_text(S(lang, "SUBMIT_NEWS_2"))
+    text = m.text or m.caption
+    if text:
+        news_posts[id].add_text(text)
+    attachment = store_attachment(m)
+    if attachment is not None:
+        news_posts[id].pending_attachments.append(attachment)
+
+        def check_download(future: Future):
+            if future.exception() is not None:
+                logger.warning(f"An attachment of a news post can't be saved: {future.exception()}")
+                admin_reply(m, S(lang, "ATTACHMENT_ERROR"))
+
+        attachment.add_done_callback(check_download)
+    admin_reply(m, S(lang, "SUBMIT_NEWS_2"))
+
+
+def cmd_admin_language(update: tg.Update, context: tgext.CallbackContext):
+    """Next texts of the news post are written for the given language, without arguments - for everyone"""
+    m = update.message
+    id, lang, text = extract_update(update)
+    if id not in news_posts:
+        news_posts[id] = NewsPost()
+    post_lang = context.args[0] if context.args else None
+    news_posts[id].editing_language = post_lang
+    admin_reply(m, S(lang, "SUBMIT_NEWS_LANGUAGE").format(post_lang or S(lang, "ALL_LANGUAGES")))
+
+
+def cmd_admin_only(update: tg.Update, context: tgext.CallbackContext):
+    """Send the news post only to subscribers of the given languages, without arguments - to everyone"""
+    m = update.message
+    id, lang, text = extract_update(update)
+    if id not in news_posts:
+        news_posts[id] = NewsPost()
+    news_posts[id].target_languages = context.args if context.args else None
+    admin_reply(m, S(lang, "SUBMIT_NEWS_TARGET").format(
+        ", ".join(context.args) if context.args else S(lang, "ALL_LANGUAGES")))
 
 
 def cmd_admin_finish(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
-    m.reply_text(S(lang, "SUBMIT_NEWS_3"))
+    admin_reply(m, S(lang, "SUBMIT_NEWS_3"))
     return CONFIRM_SUBMITTING
 
 
 def cmd_admin_confirm(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
-    publication_queue.append(news_posts[id])
+    # The next post of the admin starts empty
+    post = news_posts.pop(id, None)
+    if post is None:
+        admin_reply(m, S(lang, "UNKNOWN_ERROR"), reply_markup=admin_panel_keyboard(id, lang))
+        return SELECT_SERVICE
+    publication_queue.append(post)
     context.dispatcher.job_queue.run_once(publish_new_post, 1)
     logger.info(f"A new post was published")
-    m.reply_text(S(lang, "SUBMIT_SUCCESS"),
-                 reply_markup=admin_panel_keyboard(id, lang))
+    admin_reply(m, S(lang, "SUBMIT_SUCCESS"),
+                reply_markup=admin_panel_keyboard(id, lang))
     return SELECT_SERVICE
 
 
 def cmd_admin_cancel(update: tg.Update, context: tgext.CallbackContext):
     m = update.message
     id, lang, text = extract_update(update)
-    m.reply_text(S(lang, "REPORTING_CANCELLED"),
-                 reply_markup=admin_panel_keyboard(id, lang))
+    news_posts.pop(id, None)
+    admin_reply(m, S(lang, "REPORTING_CANCELLED"),
+                reply_markup=admin_panel_keyboard(id, lang))
     return SELECT_SERVICE
 
 
@@ -411,21 +630,35 @@ def publish_new_post(context: tgext.CallbackContext):
     publication_lock.wait()
     # Activate the lock
     publication_lock.clear()
-    bot = context.bot
-    subscriber_ids = db.list_subscribers()
-    for post in publication_queue:
-        for subscriber_id in subscriber_ids:
-            for text in post.texts:
-                bot.send_message(subscriber_id, text)
-            for photo in post.photos:
-                bot.send_photo(subscriber_id, photo)
-            for video in post.videos:
-                bot.send_video(subscriber_id, video)
-        publication_queue.remove(post)
+    segments = db.list_subscriber_segments()
+    while publication_queue:
+        post = publication_queue.pop(0)
+        # Attachments which failed to download were reported to the admin already
+        post.attachments += [future.result() for future in post.pending_attachments if not future.exception()]
+        post.pending_attachments = []
+        send_post(context.bot, post, segments)
     # Deactivate the lock
     publication_lock.set()
 
 
+def broadcast_post(bot: tg.Bot, post: NewsPost, segments: Dict[str, List[int]]):
+    """Send a news post to subscribers grouped by languages"""
+    for lang, subscriber_ids in segments.items():
+        if not post.is_targeted(lang):
+            continue
+        # The payload is prepared once for the whole segment
+        texts = post.texts_for(lang)
+        for subscriber_id in subscriber_ids:
+            for text in texts:
+                scheduler.submit(BROADCAST, subscriber_id, bot.send_message, subscriber_id, text)
+            for attachment in post.attachments:
+                scheduler.submit(BROADCAST, subscriber_id, send_attachment, bot, subscriber_id, attachment)
+
+
+# Sends a published post, cluster.py replaces it to send through workers which serve the subscribers
+send_post: Callable[[tg.Bot, NewsPost, Dict[str, List[int]]], None] = broadcast_post
+
+
 def quit_reports_viewer(admin_id):
     del viewing_status[admin_id]
     del viewed_report_id[admin_id]
@@ -436,51 +669,47 @@ def msg_handler_buttons(update: tg.Update, context: tgext.CallbackContext):
     id, lang, text = extract_update(update)
     report_status = viewing_status[id]
     report_id = viewed_report_id[id]
-    list_reports = db.list_unseen_reports if report_status == ReportStatus.UNSEEN else db.list_seen_reports
+    archived = report_status is None
+
+    def adjacent(step):
+        if archived:
+            return db.adjacent_archived_report(report_id, step)
+        return db.adjacent_report(report_id, report_status, step)
+
     if text == "⬅️":  # previous report
-        reports = list_reports()
-        try:
-            index = reports.index(report_id)
-        except ValueError:
-            m.reply_text(S(lang, "UNKNOWN_ERROR"),
-                         reply_markup=admin_panel_keyboard(id, lang))
-            quit_reports_viewer(id)
-            return AP_SELECT
-        if index == 0: # this report is first
-            m.reply_text(S(lang, "ALREADY_FIRST"))
+        previous_id = adjacent(-1)
+        if previous_id is None:  # this report is first
+            admin_reply(m, S(lang, "ALREADY_FIRST"))
             return
-        viewed_report_id[id] = reports[index - 1]
+        viewed_report_id[id] = previous_id
     elif text == "➡️":  # next report
-        reports = list_reports()
-        try:
-            index = reports.index(report_id)
-        except ValueError:
-            m.reply_text(S(lang, "UNKNOWN_ERROR"),
-                         reply_markup=admin_panel_keyboard(id, lang))
-            quit_reports_viewer(id)
-            return AP_SELECT
-        if index + 1 == len(reports): # this report is already last
-            m.reply_text(S(lang, "ALREADY_LAST"))
+        next_id = adjacent(1)
+        if next_id is None:  # this report is already last
+            admin_reply(m, S(lang, "ALREADY_LAST"))
             return
-        viewed_report_id[id] = reports[index + 1]
-    elif text == S(lang, "MARK_SEEN"):
-        # ignore if already SEEN
-        if report_status == ReportStatus.SEEN:
+        viewed_report_id[id] = next_id
+    elif text in (S(lang, "MARK_SEEN"), S(lang, "MARK_UNSEEN")):
+        # ignore if the report has the status already or it's archived
+        new_status = ReportStatus.SEEN if text == S(lang, "MARK_SEEN") else ReportStatus.UNSEEN
+        if archived or report_status == new_status:
             return
-        db.mark_report_seen(report_id)
-    elif text == S(lang, "MARK_UNSEEN"):
-        # ignore if already UNSEEN
-        if report_status == ReportStatus.UNSEEN:
+        try:
+            if new_status == ReportStatus.SEEN:
+                db.mark_report_seen(report_id)
+            else:
+                db.mark_report_unseen(report_id)
+        except KeyError:
+            # The report was archived or removed while the admin was viewing it
+            admin_reply(m, S(lang, "REPORT_IS_REMOVED"))
             return
-        db.mark_report_unseen(report_id)
     elif text == S(lang, "REMOVE_REPORT"):
         pass
     elif text == S(lang, "QUIT_VIEWING"):
-        m.reply_text(S(lang, "VIEWING_IS_QUIT"),
-                     reply_markup=admin_panel_keyboard(id, lang))
+        admin_reply(m, S(lang, "VIEWING_IS_QUIT"),
+                    reply_markup=admin_panel_keyboard(id, lang))
         quit_reports_viewer(id)
         return AP_SELECT
-    show_report(context, id, lang, viewed_report_id[id])
+    show_report(context, id, lang, viewed_report_id[id], archived)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import bot
+import data
+import unittest
+import shutil
+from concurrent.futures import Future
+import telegram as tg
+
+TEMPDIR = "/tmp/TestBotDirectory"
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestNewsPost(unittest.TestCase):
+    def setUp(self) -> None:
+        self.post = bot.NewsPost()
+        self.post.add_text("default")
+        self.post.editing_language = "en"
+        self.post.add_text("english")
+        self.post.editing_language = "en-GB"
+        self.post.add_text("british")
+
+    def test_texts_for(self):
+        self.assertListEqual(self.post.texts_for("en-GB"), ["british"])
+        self.assertListEqual(self.post.texts_for("en-US"), ["english"])
+        self.assertListEqual(self.post.texts_for("en"), ["english"])
+        self.assertListEqual(self.post.texts_for("ru"), ["default"])
+        self.assertListEqual(self.post.texts_for(""), ["default"])
+
+    def test_is_targeted(self):
+        self.assertTrue(self.post.is_targeted("kk"))
+        self.post.target_languages = ["en", "ru-RU"]
+        self.assertTrue(self.post.is_targeted("en"))
+        self.assertTrue(self.post.is_targeted("en-US"))
+        self.assertTrue(self.post.is_targeted("ru-RU"))
+        self.assertFalse(self.post.is_targeted("ru"))
+        self.assertFalse(self.post.is_targeted("kk"))
+        self.assertFalse(self.post.is_targeted(""))
+
+
+class TestAttachments(unittest.TestCase):
+    def setUp(self) -> None:
+        bot.db = data.BotDB(TEMPDIR)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_known_file_is_not_downloaded(self):
+        blob_id = bot.db.put_blob(b"photo")
+        bot.db.set_blob_file_id(blob_id, "AgAD", "unique")
+        # The photo has no bot, so downloading it would fail
+        photo = tg.PhotoSize("AgAE", "unique", 10, 10)
+        message = tg.Message(1, None, None, None, photo=[photo])
+        self.assertEqual(bot.store_attachment(message).result(1), (data.AttachmentType.PHOTO, blob_id))
+        self.assertIsNone(bot.store_attachment(tg.Message(1, None, None, None, text="text")))
+
+
+class TestSaveReport(unittest.TestCase):
+    def setUp(self) -> None:
+        bot.config = {"db_path": TEMPDIR}
+        bot.init()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_failed_attachment_is_skipped(self):
+        saved, failed = Future(), Future()
+        saved.set_result((data.AttachmentType.PHOTO, bot.db.put_blob(b"photo")))
+        failed.set_exception(tg.error.BadRequest("File is too big"))
+        message = tg.Message(1, tg.User(5, "User", False), None, tg.Chat(5, "private"), text="✅")
+        bot.save_report(message, "en", data.ReportType.OTHER, "Prices are too high", [failed, saved])
+        report = bot.db.get_report(bot.db.last_report(data.ReportStatus.UNSEEN))
+        self.assertEqual(report.msg, "Prices are too high")
+        self.assertListEqual(report.attachments, [saved.result()])
@@ -0,0 +1,244 @@
+"""Multi-process deployment of the bot.
+
+The front process receives updates from Telegram (long polling or webhook) and
+shards them by the sender's ID among worker processes, so the conversation state
+of every user stays inside one worker. Admins are always served by the first worker,
+thus news publication and the reports viewer live there too.
+
+Workers share the database through SharedBotDB. Run with: python cluster.py
+"""
+from typing import Dict, List, Optional, Iterable, Callable
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import get_context
+from json import loads
+from hmac import compare_digest
+import threading
+import logging
+import telegram as tg
+import telegram.ext as tgext
+from telegram.utils.request import Request
+
+import bot as bot_module
+from sender import SharedTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Seconds of long polling in the front process
+POLL_TIMEOUT = 30
+# How often the supervisor checks that workers are alive
+SUPERVISE_INTERVAL = 1
+# Broadcasts leave this part of the shared send limit to replies of all workers
+BROADCAST_RESERVE = 1 / 3
+
+
+def sender_id(update: Dict) -> Optional[int]:
+    """Get ID of the user who caused the update, None if there is no such user"""
+    for value in update.values():
+        if type(value) is dict and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def shard_of_user(user_id: Optional[int], workers: int, admins: Iterable[int]) -> int:
+    """Select a worker for a user, admins and updates without a user go to the first one"""
+    if user_id is None or user_id in admins:
+        return 0
+    return user_id % workers
+
+
+def shard_of(update: Dict, workers: int, admins: Iterable[int]) -> int:
+    """Select a worker for the update"""
+    return shard_of_user(sender_id(update), workers, admins)
+
+
+def split_segments(segments: Dict[str, List[int]], workers: int, admins: Iterable[int]) -> List[Dict[str, List[int]]]:
+    """Divide subscribers of language segments among the workers which serve them"""
+    shards = [{} for _ in range(workers)]
+    for lang, subscriber_ids in segments.items():
+        for subscriber_id in subscriber_ids:
+            shards[shard_of_user(subscriber_id, workers, admins)].setdefault(lang, []).append(subscriber_id)
+    return shards
+
+
+def make_bot(config: Dict, con_pool_size: int = 1) -> tg.Bot:
+    """Create a Bot, tg_base_url allows to use another Bot API server, e.g. a stub"""
+    return tg.Bot(config["tg_key"], base_url=config.get("tg_base_url"),
+                  request=Request(con_pool_size=con_pool_size))
+
+
+def make_webhook_handler(secret_path: str, dispatch: Callable[[Dict], None]):
+    """Make a handler class which accepts updates only on the secret path, it's known only to Telegram"""
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not compare_digest(self.path.encode(), f"/{secret_path}".encode()):
+                self.send_response(403)
+                self.end_headers()
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                update = loads(self.rfile.read(length))
+            except ValueError:
+                update = None
+            if type(update) is not dict:
+                self.send_response(400)
+                self.end_headers()
+                return
+            dispatch(update)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def broadcast_job(context: tgext.CallbackContext):
+    post, segments = context.job.context
+    bot_module.broadcast_post(context.bot, post, segments)
+
+
+def worker_main(index: int, config: Dict, queues: List, bucket_state, bucket_lock):
+    """Process updates of one shard, runs in a worker process.
+
+    Messages to a chat are sent only by the worker which serves it, so its limits are kept,
+    a published post is forwarded to the workers of its subscribers.
+    """
+    workers, admins = len(queues), set(config.get("admins", []))
+    # All workers send within one limit of the bot
+    rate = config.get("send_rate", bot_module.DEFAULT_SEND_RATE)
+    bot_module.config = config
+    bot_module.init(shared_db=True, send_bucket=SharedTokenBucket(rate, rate, bucket_state, bucket_lock),
+                    broadcast_reserve=rate * BROADCAST_RESERVE)
+
+    def send_post(bot: tg.Bot, post: bot_module.NewsPost, segments: Dict[str, List[int]]):
+        for shard, shard_segments in enumerate(split_segments(segments, workers, admins)):
+            if shard_segments:
+                queues[shard].put((post, shard_segments))
+
+    bot_module.send_post = send_post
+    # The dispatcher and the job queue send requests from different threads
+    bot = make_bot(config, con_pool_size=8)
+    job_queue = tgext.JobQueue()
+    dispatcher = tgext.Dispatcher(bot, None, job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    bot_module.add_handlers(dispatcher)
+    # Only one worker archives reports
+    if index == 0:
+        bot_module.schedule_archiving(job_queue)
+    job_queue.start()
+    logger.info(f"Worker {index} is ready")
+    while True:
+        item = queues[index].get()
+        # None is sent when the cluster stops
+        if item is None:
+            break
+        # Updates are dicts, a post with its subscribers is a tuple
+        if type(item) is tuple:
+            # The post is sent by the job queue, so updates are processed meanwhile
+            job_queue.run_once(broadcast_job, 0, context=item)
+        else:
+            dispatcher.process_update(tg.Update.de_json(item, bot))
+    job_queue.stop()
+
+
+class Cluster:
+    def __init__(self, config: Dict):
+        self.config = config
+        self.workers: int = config.get("workers", 1)
+        self.admins = set(config.get("admins", []))
+        # spawn is used so no locks or connections are inherited from the front process
+        self._context = get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(self.workers)]
+        rate = config.get("send_rate", bot_module.DEFAULT_SEND_RATE)
+        self._bucket_state, self._bucket_lock = SharedTokenBucket.make_state(self._context, rate)
+        self._processes: List = [None] * self.workers
+        self._stop_event = threading.Event()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(target=worker_main, name=f"worker_{index}",
+                                        args=(index, self.config, self._queues, self._bucket_state,
+                                              self._bucket_lock))
+        process.start()
+        self._processes[index] = process
+
+    def _supervise(self):
+        """Restart workers that have died"""
+        while not self._stop_event.wait(SUPERVISE_INTERVAL):
+            for index, process in enumerate(self._processes):
+                if not process.is_alive() and not self._stop_event.is_set():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self._start_worker(index)
+
+    def dispatch(self, update: Dict):
+        """Send an update as a JSON dict to its worker"""
+        self._queues[shard_of(update, self.workers, self.admins)].put(update)
+
+    def _poll(self, bot: tg.Bot):
+        """Receive updates by long polling, they are not parsed in the front process"""
+        bot.delete_webhook()
+        offset = 0
+        url = f"{bot.base_url}/getUpdates"
+        while not self._stop_event.is_set():
+            try:
+                updates = bot.request.post(url, {"offset": offset, "timeout": POLL_TIMEOUT},
+                                           timeout=POLL_TIMEOUT + 2)
+            except tg.error.TelegramError as e:
+                logger.warning(f"Polling failed: {e}")
+                self._stop_event.wait(SUPERVISE_INTERVAL)
+                continue
+            for update in updates:
+                self.dispatch(update)
+                offset = update["update_id"] + 1
+
+    def _serve_webhook(self, bot: tg.Bot):
+        """Receive updates by webhook, TLS is expected to be terminated by a reverse proxy.
+
+        webhook["url"] is the public URL of the server, updates are posted to its secret path,
+        webhook["path"] or the bot token by default, so nobody else can send fake updates.
+        """
+        webhook = self.config["webhook"]
+        secret_path = webhook.get("path", self.config["tg_key"])
+        self._httpd = ThreadingHTTPServer((webhook.get("listen", "0.0.0.0"), webhook["port"]),
+                                          make_webhook_handler(secret_path, self.dispatch))
+        bot.set_webhook(url=f"{webhook['url'].rstrip('/')}/{secret_path}")
+        self._httpd.serve_forever()
+
+    def run(self):
+        """Start the workers and receive updates until stop() is called"""
+        logger.info(f"Launching {bot_module.VERSION} with {self.workers} workers")
+        for index in range(self.workers):
+            self._start_worker(index)
+        threading.Thread(target=self._supervise, name="supervisor", daemon=True).start()
+        bot = make_bot(self.config)
+        try:
+            if "webhook" in self.config:
+                self._serve_webhook(bot)
+            else:
+                self._poll(bot)
+        finally:
+            self._stop_event.set()
+            for queue in self._queues:
+                queue.put(None)
+            for process in self._processes:
+                process.join()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+
+
+def main():
+    bot_module.load_config()
+    cluster = Cluster(bot_module.config)
+    try:
+        cluster.run()
+    except KeyboardInterrupt:
+        logger.info("Stopped")
+
+
+if __name__ == '__main__':
+    main()
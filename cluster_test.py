@@ -0,0 +1,181 @@
+import cluster
+import data
+import unittest
+import threading
+import shutil
+import json
+import time
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TEMPDIR = "/tmp/TestClusterDirectory"
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "language_code": "en"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]
+            if text.startswith("/") else []
+        }
+    }
+
+
+class StubTelegramAPI:
+    """Local Bot API server which serves prepared updates and records sent messages"""
+
+    def __init__(self):
+        self.updates = []
+        self.sent = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                body = json.dumps({"ok": True, "result": stub.call(method, data)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/bot"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def call(self, method, data):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method == "getMyCommands":
+            return []
+        elif method == "getUpdates":
+            # Short "long polling" so the cluster can stop quickly
+            time.sleep(0.1)
+            with self.lock:
+                return [u for u in self.updates if u["update_id"] >= int(data.get("offset", 0))]
+        elif method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            with self.lock:
+                self.sent.append((chat_id, data["text"]))
+                return {"message_id": len(self.sent), "date": 0, "text": data["text"],
+                        "chat": {"id": chat_id, "type": "private"}}
+        return True
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+class TestSharding(unittest.TestCase):
+    def test_same_user_same_worker(self):
+        for user_id in range(100, 110):
+            shards = {cluster.shard_of(make_update(i, user_id, "hi"), 4, []) for i in range(5)}
+            self.assertEqual(len(shards), 1)
+
+    def test_admins_pinned(self):
+        admins = [7, 13]
+        for admin in admins:
+            self.assertEqual(cluster.shard_of(make_update(1, admin, "/admin"), 4, admins), 0)
+
+    def test_no_user(self):
+        self.assertEqual(cluster.shard_of({"update_id": 1, "poll": {"id": "1"}}, 4, []), 0)
+
+    def test_split_segments(self):
+        shards = cluster.split_segments({"en": [4, 5, 7], "ru": [6]}, 2, [7])
+        self.assertListEqual(shards, [{"en": [4, 7], "ru": [6]}, {"en": [5]}])
+
+
+class TestCluster(unittest.TestCase):
+    def setUp(self) -> None:
+        self.api = StubTelegramAPI()
+
+    def tearDown(self) -> None:
+        self.api.shutdown()
+        shutil.rmtree(TEMPDIR, ignore_errors=True)
+
+    def test_start_replies(self):
+        users = [1001, 1002, 1003, 1004]
+        self.api.updates = [make_update(i + 1, user, "/start") for i, user in enumerate(users)]
+        c = cluster.Cluster({"tg_key": "123:STUB", "tg_base_url": self.api.base_url,
+                             "db_path": TEMPDIR, "admins": [], "workers": 2})
+        thread = threading.Thread(target=c.run)
+        thread.start()
+        try:
+            deadline = time.time() + 60
+            while time.time() < deadline:
+                with self.api.lock:
+                    if len(self.api.sent) >= len(users):
+                        break
+                time.sleep(0.1)
+        finally:
+            c.stop()
+            thread.join()
+        self.assertListEqual(sorted(chat_id for chat_id, _ in self.api.sent), users)
+
+    def test_write_report(self):
+        with open("languages/en.json", encoding="utf-8") as f:
+            strings = json.load(f)
+        steps = ["/start", strings["BUTTON_WRITE_REPORT"], strings["TYPE_OTHER"], "Prices are too high", "✅"]
+        self.api.updates = [make_update(i + 1, 1001, text) for i, text in enumerate(steps)]
+        c = cluster.Cluster({"tg_key": "123:STUB", "tg_base_url": self.api.base_url,
+                             "db_path": TEMPDIR, "admins": [], "workers": 2})
+        thread = threading.Thread(target=c.run)
+        thread.start()
+        try:
+            deadline = time.time() + 60
+            while time.time() < deadline:
+                with self.api.lock:
+                    if (1001, strings["THANK_YOU_FOR_REPORT"]) in self.api.sent:
+                        break
+                time.sleep(0.1)
+        finally:
+            c.stop()
+            thread.join()
+        self.assertIn((1001, strings["THANK_YOU_FOR_REPORT"]), self.api.sent)
+        db = data.BotDB(TEMPDIR)
+        db.load()
+        reports = db.list_reports()
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(db.get_report(reports[0]).msg, "Prices are too high")
+
+
+class TestWebhook(unittest.TestCase):
+    def setUp(self) -> None:
+        self.updates = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0),
+                                         cluster.make_webhook_handler("secret", self.updates.append))
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def post(self, path, body):
+        request = urllib.request.Request(f"http://127.0.0.1:{self.httpd.server_port}{path}", data=body)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_secret_path(self):
+        update = json.dumps(make_update(1, 1001, "/start")).encode()
+        self.assertEqual(self.post("/secret", update), 200)
+        self.assertEqual(self.post("/", update), 403)
+        self.assertEqual(self.post("/secret2", update), 403)
+        self.assertEqual(self.post("/secret", b"{not json"), 400)
+        self.assertEqual(self.post("/secret", b"[]"), 400)
+        self.assertListEqual([u["update_id"] for u in self.updates], [1])
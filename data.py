@@ -1,9 +1,29 @@
-from threading import Event
-from typing import Optional, List
-from os import stat, mkdir
-from json import load, dump
+from threading import Lock
+from typing import Optional, List, Dict, Callable, Set, Tuple, BinaryIO
+from zipfile import ZipFile, ZIP_DEFLATED
+from itertools import chain, compress, repeat
+from operator import ge, lt
+from bisect import bisect_left, bisect_right
+from array import array
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from sys import byteorder
+from os import stat, fstat, mkdir, replace, remove, link, listdir, fdopen, getpid
+from os.path import exists
+from shutil import rmtree
+from tempfile import mkstemp
+from hashlib import sha256
+from fcntl import flock, LOCK_EX, LOCK_UN, LOCK_NB
+from json import load, loads, dump, dumps
 from enum import IntEnum
 from time import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Subscribers whose language is unknown are kept in this segment
+NO_LANGUAGE = ""
 
 
 class ReportType(IntEnum):
@@ -17,20 +37,385 @@ class ReportStatus(IntEnum):
     REMOVED = 2
 
 
+class AttachmentType(IntEnum):
+    PHOTO = 0
+    VIDEO = 1
+
+
+# Type of a photo or a video and ID of its blob
+Attachment = Tuple[AttachmentType, str]
+
+
+def attachments_from_list(attachments: list) -> List[Attachment]:
+    return [(AttachmentType(type), blob_id) for type, blob_id in attachments]
+
+
 class Report:
+    """A report record, its message and attachments can be loaded only on the first access by the loader"""
+    __slots__ = ("id", "type", "status", "date", "_msg", "_attachments", "_loader")
+
     def __init__(self, id: int, type: ReportType, status: ReportStatus,
-                 date: int, msg: Optional[str]):
+                 date: float, msg: Optional[str] = None,
+                 loader: Optional[Callable[[int], dict]] = None,
+                 attachments: Optional[List[Attachment]] = None):
         self.id: int = id
         self.type: ReportType = type
         self.status: ReportStatus = status
-        self.date: int = date
-        self.msg: Optional[str] = msg
+        self.date: float = date
+        self._msg: Optional[str] = msg
+        self._attachments: List[Attachment] = attachments or []
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is not None:
+            report_dict = self._loader(self.id)
+            self._msg = report_dict["msg"]
+            self._attachments = attachments_from_list(report_dict.get("attachments", []))
+            self._loader = None
+
+    @property
+    def msg(self) -> Optional[str]:
+        """Message of the report, may raise KeyError if the report was removed before loading"""
+        self._load()
+        return self._msg
+
+    @property
+    def attachments(self) -> List[Attachment]:
+        """Photos and videos of the report, may raise KeyError like msg"""
+        self._load()
+        return self._attachments
+
+
+def _value_table(value: int) -> bytes:
+    """Table for bytes.translate which maps the value to 1 and other bytes to 0"""
+    table = bytearray(256)
+    table[value] = 1
+    return bytes(table)
+
+
+class ReportCatalog:
+    """Metadata of all reports kept in columns sorted by ID, one element per report"""
+
+    def __init__(self):
+        self.ids = array("Q")
+        self.types = bytearray()
+        self.statuses = bytearray()
+        self.dates = array("d")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, id: int, type: ReportType, status: ReportStatus, date: float):
+        """Add a report, its ID must be greater than IDs of other reports"""
+        self.ids.append(id)
+        self.types.append(type)
+        self.statuses.append(status)
+        self.dates.append(date)
+
+    def position(self, id: int) -> int:
+        """Get position of a report in columns, raises KeyError if there is no such report"""
+        i = bisect_left(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise KeyError(id)
+        return i
+
+    def get(self, id: int) -> Report:
+        """Get a Report without its message"""
+        i = self.position(id)
+        return Report(id, ReportType(self.types[i]), ReportStatus(self.statuses[i]), self.dates[i])
+
+    def select(self, status: Optional[ReportStatus] = None, type: Optional[ReportType] = None,
+               since: Optional[float] = None, until: Optional[float] = None) -> List[int]:
+        """IDs of reports with the status and the type which were written in [since, until)"""
+        # Masks are bytes with 1 for selected reports, byte columns are scanned by translate
+        masks = []
+        if status is not None:
+            masks.append(self.statuses.translate(_value_table(status)))
+        if type is not None:
+            masks.append(self.types.translate(_value_table(type)))
+        if since is not None:
+            masks.append(bytes(map(ge, self.dates, repeat(since))))
+        if until is not None:
+            masks.append(bytes(map(lt, self.dates, repeat(until))))
+        if not masks:
+            return self.ids.tolist()
+        mask = masks[0]
+        if len(masks) > 1:
+            # 0/1 bytes are ANDed as big integers
+            bits = int.from_bytes(mask, "little")
+            for other in masks[1:]:
+                bits &= int.from_bytes(other, "little")
+            mask = bits.to_bytes(len(mask), "little")
+        return list(compress(self.ids, mask))
+
+    def adjacent(self, id: int, status: ReportStatus, step: int) -> Optional[int]:
+        """The closest report with the status after (step > 0) or before (step < 0) the ID"""
+        if step > 0:
+            i = self.statuses.find(status, bisect_right(self.ids, id))
+        else:
+            i = self.statuses.rfind(status, 0, bisect_left(self.ids, id))
+        return self.ids[i] if i >= 0 else None
+
+    def drop(self, ids: Set[int]):
+        """Remove reports from the catalog"""
+        keep = [id not in ids for id in self.ids]
+        self.ids = array("Q", compress(self.ids, keep))
+        self.types = bytearray(compress(self.types, keep))
+        self.statuses = bytearray(compress(self.statuses, keep))
+        self.dates = array("d", compress(self.dates, keep))
+
+
+class ArchiveIndex:
+    """Which archive segment keeps an archived report.
+
+    The index is a table of segments which is only appended, sorted IDs of each segment
+    are kept in a binary file next to the segment, so archiving never rewrites the index.
+    """
+    # segment number, number of IDs, the least and the greatest ID of the segment
+    RECORD = Struct("<IQQQ")
+
+    def __init__(self):
+        # Segments in order of archiving, with their sorted IDs
+        self.segments = array("L")
+        self.min_ids = array("Q")
+        self.max_ids = array("Q")
+        self.ids: List[array] = []
+        self.next_segment = 0
+        # The greatest ID that was ever archived, IDs of new reports must be greater
+        self.max_id = 0
+
+    def __len__(self):
+        return sum(map(len, self.ids))
+
+    def segment_of(self, id: int) -> int:
+        """Get the segment number of a report, raises KeyError if it's not archived"""
+        # A report archived again is found in the newer segment
+        for i in reversed(range(len(self.segments))):
+            if self.min_ids[i] <= id <= self.max_ids[i]:
+                ids = self.ids[i]
+                j = bisect_left(ids, id)
+                if j < len(ids) and ids[j] == id:
+                    return self.segments[i]
+        raise KeyError(id)
+
+    def adjacent(self, id: int, step: int) -> Optional[int]:
+        """The closest archived report after (step > 0) or before (step < 0) the ID"""
+        closest = []
+        for ids in self.ids:
+            i = bisect_right(ids, id) if step > 0 else bisect_left(ids, id) - 1
+            if 0 <= i < len(ids):
+                closest.append(ids[i])
+        return (min if step > 0 else max)(closest, default=None)
+
+    def add(self, segment: int, ids: array):
+        """Add a new segment with its sorted IDs"""
+        self.segments.append(segment)
+        self.min_ids.append(ids[0])
+        self.max_ids.append(ids[-1])
+        self.ids.append(ids)
+        self.next_segment = max(self.next_segment, segment + 1)
+        self.max_id = max(self.max_id, ids[-1])
+
+    @classmethod
+    def records(cls, data: bytes) -> List[Tuple[int, int, int, int]]:
+        """Complete records of the table, the last one can be incomplete if a writer has crashed"""
+        return list(cls.RECORD.iter_unpack(data[:len(data) - len(data) % cls.RECORD.size]))
+
+
+class SubscriberSegments:
+    """IDs of subscribers in sorted arrays, one array per language"""
+
+    def __init__(self):
+        self.segments: Dict[str, array] = {}
+
+    def __len__(self):
+        return sum(map(len, self.segments.values()))
+
+    def language_of(self, tg_id: int) -> Optional[str]:
+        for lang, ids in self.segments.items():
+            i = bisect_left(ids, tg_id)
+            if i < len(ids) and ids[i] == tg_id:
+                return lang
+        return None
+
+    def add(self, tg_id: int, lang: str):
+        """Add a subscriber, he/she is removed from the segment of another language"""
+        self.remove(tg_id)
+        ids = self.segments.setdefault(lang, array("q"))
+        ids.insert(bisect_left(ids, tg_id), tg_id)
+
+    def remove(self, tg_id: int):
+        for lang, ids in self.segments.items():
+            i = bisect_left(ids, tg_id)
+            if i < len(ids) and ids[i] == tg_id:
+                del ids[i]
+                if not ids:
+                    del self.segments[lang]
+                return
+
+    def to_lists(self) -> Dict[str, List[int]]:
+        return {lang: ids.tolist() for lang, ids in self.segments.items()}
+
+
+def _native_array(typecode: str, data) -> array:
+    """Make an array from little-endian bytes"""
+    column = array(typecode)
+    column.frombytes(data)
+    if byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _little_endian_bytes(column: array) -> bytes:
+    if byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+class DBIndex:
+    """Catalog of reports, subscribers and Telegram file_ids of blobs.
+
+    It's persisted as a binary snapshot which is loaded through mmap, changes made after
+    the snapshot are appended to a log of the same generation and replayed on loading.
+    """
+    MAGIC = b"KZBOTIDX"
+    VERSION = 1
+    # magic, version, generation, number of reports, number of subscriber segments
+    HEADER = Struct("<8sIQQI")
+    # length of the language code, number of subscribers
+    SEGMENT_HEADER = Struct("<HQ")
+    # length of JSON with file_ids
+    FILE_IDS_HEADER = Struct("<Q")
+
+    def __init__(self, generation: int = 0):
+        self.generation = generation
+        self.catalog = ReportCatalog()
+        self.subscribers = SubscriberSegments()
+        # Blob ID -> Telegram file_id, so the same file is never uploaded twice
+        self.file_ids: Dict[str, str] = {}
+        # Telegram file_unique_id -> blob ID, so the same file is never downloaded twice
+        self.unique_ids: Dict[str, str] = {}
+
+    def apply(self, record: list):
+        """Apply a change from the log"""
+        op = record[0]
+        if op == "add":
+            self.catalog.append(record[1], record[2], ReportStatus.UNSEEN, record[3])
+        elif op == "status":
+            self.catalog.statuses[self.catalog.position(record[1])] = record[2]
+        elif op == "drop":
+            self.catalog.drop(set(record[1]))
+        elif op == "subscribe":
+            self.subscribers.add(record[1], record[2])
+        elif op == "unsubscribe":
+            self.subscribers.remove(record[1])
+        elif op == "file_id":
+            self.file_ids[record[1]] = record[2]
+            if record[3] is not None:
+                self.unique_ids[record[3]] = record[1]
+        else:
+            raise ValueError(f"Unknown log record {record}")
+
+    def replay(self, data: bytes) -> Tuple[int, int]:
+        """Apply complete records of a log, returns numbers of used bytes and records.
+
+        The last record can be incomplete if a writer has crashed, it's ignored.
+        Replaying stops at a damaged record, the next write to the log replaces it and everything after it.
+        """
+        used, records = 0, 0
+        while True:
+            end = data.find(b"\n", used) + 1
+            if end == 0:
+                return used, records
+            try:
+                self.apply(loads(data[used:end]))
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                logger.warning(f"The index log is damaged after {records} records, the rest is ignored: {e}")
+                return used, records
+            used, records = end, records + 1
+
+    @staticmethod
+    def log_record(*record) -> bytes:
+        return dumps(record, separators=(",", ":")).encode() + b"\n"
+
+    def write(self, fp):
+        catalog = self.catalog
+        fp.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.generation,
+                                  len(catalog), len(self.subscribers.segments)))
+        fp.write(_little_endian_bytes(catalog.ids))
+        fp.write(_little_endian_bytes(catalog.dates))
+        fp.write(catalog.types)
+        fp.write(catalog.statuses)
+        for lang, ids in self.subscribers.segments.items():
+            encoded_lang = lang.encode()
+            fp.write(self.SEGMENT_HEADER.pack(len(encoded_lang), len(ids)))
+            fp.write(encoded_lang)
+            fp.write(_little_endian_bytes(ids))
+        file_ids = dumps({"file_ids": self.file_ids, "unique_ids": self.unique_ids}).encode()
+        fp.write(self.FILE_IDS_HEADER.pack(len(file_ids)))
+        fp.write(file_ids)
+
+    @classmethod
+    def read(cls, path: str) -> "DBIndex":
+        """Load a snapshot, columns are copied from the mapped file at once"""
+        with open(path, "rb") as fp, mmap(fp.fileno(), 0, access=ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                magic, version, generation, reports, segments = cls.HEADER.unpack_from(view)
+                if magic != cls.MAGIC or version > cls.VERSION:
+                    raise ValueError(f"{path} has unknown format")
+                index = cls(generation)
+                catalog = index.catalog
+                offset = cls.HEADER.size
+                catalog.ids = _native_array("Q", view[offset:offset + 8 * reports])
+                offset += 8 * reports
+                catalog.dates = _native_array("d", view[offset:offset + 8 * reports])
+                offset += 8 * reports
+                catalog.types = bytearray(view[offset:offset + reports])
+                offset += reports
+                catalog.statuses = bytearray(view[offset:offset + reports])
+                offset += reports
+                for _ in range(segments):
+                    lang_length, count = cls.SEGMENT_HEADER.unpack_from(view, offset)
+                    offset += cls.SEGMENT_HEADER.size
+                    lang = bytes(view[offset:offset + lang_length]).decode()
+                    offset += lang_length
+                    index.subscribers.segments[lang] = _native_array("q", view[offset:offset + 8 * count])
+                    offset += 8 * count
+                length, = cls.FILE_IDS_HEADER.unpack_from(view, offset)
+                offset += cls.FILE_IDS_HEADER.size
+                file_ids = loads(bytes(view[offset:offset + length]))
+                index.file_ids, index.unique_ids = file_ids["file_ids"], file_ids["unique_ids"]
+            finally:
+                view.release()
+        return index
 
 
 class BotDB:
+    FILE_INDEX = "index.bin"
+    FILE_INDEX_LOG = "index_{}.log"
+    FILE_REPORT = "report_{}.json"
+    FILE_ARCHIVE_INDEX = "archive_index.bin"
+    FILE_ARCHIVE_SEGMENT = "archive_{}.zip"
+    FILE_ARCHIVE_IDS = "archive_{}.ids"
+    # Archived reports are split into segments of at most this size
+    ARCHIVE_SEGMENT_SIZE = 10000
+    # How many archive segments are kept open
+    OPEN_SEGMENTS = 4
+    # Photos and videos are kept once per content, file names are SHA-256 of the content
+    DIR_BLOBS = "blobs"
+    FILE_BLOB = "blobs/{}"
+    # The index snapshot is written again after this many changes in the log
+    COMPACT_AFTER = 10000
+    # Files of old databases, they are converted to the index on the first start
     FILE_SUBSCRIBERS = "subscribers.json"
     FILE_REPORTS_INDEX = "reports_index.json"
-    FILE_REPORT = "report_{}.json"
+    # While a snapshot is running, old versions of changed files are kept in this directory
+    DIR_SNAPSHOT = ".snapshot"
+    FILE_SNAPSHOT_PIN = "pin"
+    FILE_MANIFEST = "manifest.json"
+    SNAPSHOT_VERSION = 1
 
     def __init__(self, db_path):
         try:
@@ -39,159 +424,613 @@ class BotDB:
             mkdir(db_path)
         self.db_path = db_path
 
-        self._lock_event = Event()
-        self._lock_event.set()
+        # Threads of the bot (dispatcher, jobs, senders) use the database at once
+        self._thread_lock = Lock()
+
+        # The index is read again only if its snapshot was replaced, by this or another process,
+        # otherwise only new records of the log are applied
+        self._index = DBIndex()
+        self._index_stat = None
+        self._log_offset = 0
+        self._log_records = 0
+        # The archive index is only appended, new records are read from this offset
+        self._archive = ArchiveIndex()
+        self._archive_offset = 0
+        # Segments never change after writing, so they can stay open
+        self._open_segments: Dict[int, ZipFile] = {}
 
     def _lock(self):
         """Lock the database"""
-        # Wait until the lock is True
-        self._lock_event.wait()
-        # Make the lock false
-        self._lock_event.clear()
+        self._thread_lock.acquire()
 
     def _unlock(self):
         """Unlock the database"""
-        self._lock_event.set()
+        self._thread_lock.release()
 
-    def list_subscribers(self) -> List[int]:
-        """Return the list of subscribers"""
+    def load(self) -> int:
+        """Read the index now instead of the first request, returns the number of reports"""
+        self._lock()
         try:
-            self._lock()
-            fp = open(f"{self.db_path}/{self.FILE_SUBSCRIBERS}", "r")
-            subscribers = load(fp)
-            fp.close()
+            return len(self._refresh().catalog)
+        finally:
             self._unlock()
-            return subscribers
-        except FileNotFoundError:
+
+    def list_subscriber_segments(self) -> Dict[str, List[int]]:
+        """Return subscribers grouped by their language codes"""
+        self._lock()
+        try:
+            return self._refresh().subscribers.to_lists()
+        finally:
             self._unlock()
-            return []
 
-    def _overwrite_subscribers(self, subscribers):
-        """Overwrite the file with new subscribers"""
+    def list_subscribers(self) -> List[int]:
+        """Return the list of subscribers"""
+        segments = self.list_subscriber_segments()
+        return sorted(chain.from_iterable(segments.values()))
+
+    def get_subscriber_language(self, tg_id: int) -> Optional[str]:
+        """Return the language segment of a subscriber or None if he/she is not subscribed"""
         self._lock()
-        fp = open(f"{self.db_path}/{self.FILE_SUBSCRIBERS}", "w")
-        subscribers.sort()
-        dump(subscribers, fp)
-        fp.close()
-        self._unlock()
+        try:
+            return self._refresh().subscribers.language_of(tg_id)
+        finally:
+            self._unlock()
 
     def is_user_subscribed(self, tg_id: int):
-        return tg_id in self.list_subscribers()
+        return self.get_subscriber_language(tg_id) is not None
 
-    def subscribe_user(self, tg_id: int):
-        """Subscribe a user to the mailing"""
-        subscribers = self.list_subscribers()
-        if tg_id not in subscribers:
-            subscribers.append(tg_id)
-            self._overwrite_subscribers(subscribers)
+    def subscribe_user(self, tg_id: int, lang: Optional[str] = None):
+        """Subscribe a user to the mailing, subscribing again moves the user to another language"""
+        lang = lang or NO_LANGUAGE
+        self._lock()
+        try:
+            if self._refresh().subscribers.language_of(tg_id) != lang:
+                self._log("subscribe", tg_id, lang)
+        finally:
+            self._unlock()
 
     def unsubscribe_user(self, tg_id: int):
         """Do vice versa"""
-        subscribers = self.list_subscribers()
+        self._lock()
         try:
-            subscribers.remove(tg_id)
-        except:
-            pass
-        self._overwrite_subscribers(subscribers)
-
-    def _get_next_report_id(self) -> int:
-        """Returns ID of last report plus 1"""
-        return self.max_report_id() + 1
+            if self._refresh().subscribers.language_of(tg_id) is not None:
+                self._log("unsubscribe", tg_id)
+        finally:
+            self._unlock()
 
     def max_report_id(self) -> int:
         """Returns the greatest ID among reports"""
+        self._lock()
+        try:
+            return self._max_report_id()
+        finally:
+            self._unlock()
+
+    def _max_report_id(self) -> int:
+        """The greatest ID among hot and archived reports, the database must be locked"""
+        catalog = self._refresh().catalog
+        return max(catalog.ids[-1] if len(catalog) > 0 else 0, self._load_archive().max_id)
+
+    def _write_json(self, name: str, obj):
+        """Atomically replace a file of the database, the database must be locked"""
+        path = f"{self.db_path}/{name}"
+        with open(f"{path}.tmp", "w") as fp:
+            dump(obj, fp)
+        self._preserve(name)
+        replace(f"{path}.tmp", path)
+
+    def _remove_file(self, name: str):
+        """Remove a file of the database, the database must be locked"""
+        self._preserve(name)
+        remove(f"{self.db_path}/{name}")
+
+    def _preserve(self, name: str):
+        """Keep the current version of a file for a running snapshot, the database must be locked.
+
+        Files are only replaced or removed, never changed in place, so a hard link keeps the old version.
+        The log of the index is appended only, its size at the moment of snapshot is enough.
+        """
+        snapshot_dir = f"{self.db_path}/{self.DIR_SNAPSHOT}"
+        if not exists(f"{snapshot_dir}/{self.FILE_SNAPSHOT_PIN}"):
+            return
+        if not self._is_snapshot_running():
+            # Files are not kept for a crashed snapshot, they would pile up forever
+            logger.warning(f"{snapshot_dir} is left by a failed snapshot, it's removed")
+            rmtree(snapshot_dir)
+            return
+        try:
+            link(f"{self.db_path}/{name}", f"{snapshot_dir}/{name}")
+        except (FileNotFoundError, FileExistsError):
+            # The file is new or its version at the moment of snapshot is kept already
+            pass
+
+    def _is_snapshot_running(self) -> bool:
+        """Whether a process holds the snapshot pin, the database must be locked.
+
+        The pin is locked with flock while the snapshot runs, the lock is released when its process dies.
+        """
+        try:
+            fp = open(f"{self.db_path}/{self.DIR_SNAPSHOT}/{self.FILE_SNAPSHOT_PIN}", "r")
+        except FileNotFoundError:
+            return False
+        with fp:
+            try:
+                flock(fp, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                return True
+            return False
+
+    def snapshot(self, dest: str, base: Optional[str] = None) -> dict:
+        """Copy the database as it was at the moment of calling to a new directory dest.
+
+        Writers are blocked only while the snapshot is pinned, the files are copied after that.
+        If base is a previous snapshot, unchanged files are hard linked from it instead of copying.
+        Returns the manifest which is saved in dest too.
+        """
+        snapshot_dir = f"{self.db_path}/{self.DIR_SNAPSHOT}"
+        self._lock()
+        try:
+            try:
+                mkdir(snapshot_dir)
+            except FileExistsError:
+                if self._is_snapshot_running():
+                    raise RuntimeError(f"Another snapshot is running, {snapshot_dir} is pinned")
+                logger.warning(f"{snapshot_dir} is left by a failed snapshot, it's removed")
+                rmtree(snapshot_dir)
+                mkdir(snapshot_dir)
+            # The pin stays locked until the snapshot ends, the owner is written for people
+            pin = open(f"{snapshot_dir}/{self.FILE_SNAPSHOT_PIN}", "w")
+            flock(pin, LOCK_EX | LOCK_NB)
+            dump({"pid": getpid(), "started": time()}, pin)
+            pin.flush()
+            try:
+                # Only names are taken under the lock, files created later are not in the snapshot
+                index = self._refresh()
+                indexes = [self.FILE_INDEX] if exists(f"{self.db_path}/{self.FILE_INDEX}") else []
+                # The log is only appended, so its beginning is the log at this moment
+                log_name, log_size = self.FILE_INDEX_LOG.format(index.generation), self._log_offset
+                report_ids = array("Q", index.catalog.ids)
+                # The archive index is only appended too
+                segments = self._load_archive().next_segment
+                archive_size = self._archive_offset
+            except BaseException:
+                rmtree(snapshot_dir)
+                pin.close()
+                raise
+        finally:
+            self._unlock()
+        try:
+            # Blobs are never changed or removed, so they're listed without the lock,
+            # blobs written meanwhile are copied too, reports of the snapshot just don't refer to them
+            blobs = self._list_blobs()
+            base_files = {}
+            if base is not None:
+                with open(f"{base}/{self.FILE_MANIFEST}", "r") as fp:
+                    base_files = load(fp)["files"]
+            mkdir(dest)
+            if blobs:
+                mkdir(f"{dest}/{self.DIR_BLOBS}")
+            names = chain(
+                indexes,
+                map(self.FILE_REPORT.format, report_ids),
+                map(self.FILE_ARCHIVE_SEGMENT.format, range(segments)),
+                map(self.FILE_ARCHIVE_IDS.format, range(segments)),
+                map(self.FILE_BLOB.format, blobs)
+            )
+            files = {}
+            for name in names:
+                entry = self._snapshot_file(name, dest, base, base_files.get(name))
+                if entry is not None:
+                    files[name] = entry
+            if log_size > 0:
+                files[log_name] = self._snapshot_file(log_name, dest, None, None, log_size)
+            if archive_size > 0:
+                files[self.FILE_ARCHIVE_INDEX] = self._snapshot_file(self.FILE_ARCHIVE_INDEX, dest, None, None,
+                                                                     archive_size)
+            manifest = {
+                "version": self.SNAPSHOT_VERSION,
+                "date": time(),
+                "base": base,
+                "files": files
+            }
+            with open(f"{dest}/{self.FILE_MANIFEST}", "w") as fp:
+                dump(manifest, fp)
+            return manifest
+        finally:
+            self._lock()
+            try:
+                rmtree(snapshot_dir)
+            finally:
+                pin.close()
+                self._unlock()
+
+    def _snapshot_file(self, name: str, dest: str, base: Optional[str], base_entry: Optional[dict],
+                       size: Optional[int] = None) -> Optional[dict]:
+        """Copy a file or its first size bytes to the snapshot, returns its manifest entry or None if it didn't exist"""
         try:
-            return max(self.list_reports())
-        except ValueError:
-            return 0
+            fp = open(f"{self.db_path}/{name}", "rb")
+        except FileNotFoundError:
+            fp = None
+        # A writer keeps the old version before replacing the file, if it's kept, that's the right one
+        try:
+            preserved = open(f"{self.db_path}/{self.DIR_SNAPSHOT}/{name}", "rb")
+            if fp is not None:
+                fp.close()
+            fp = preserved
+        except FileNotFoundError:
+            if fp is None:
+                return None
+        with fp:
+            st = fstat(fp.fileno())
+            size = st.st_size if size is None else size
+            if base_entry is not None and \
+                    (base_entry["size"], base_entry["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+                try:
+                    link(f"{base}/{name}", f"{dest}/{name}")
+                    return base_entry
+                except OSError:
+                    # Another file system, the file is copied
+                    pass
+            digest = sha256()
+            left = size
+            with open(f"{dest}/{name}", "wb") as out:
+                while left > 0:
+                    chunk = fp.read(min(left, 1 << 16))
+                    if not chunk:
+                        break
+                    left -= len(chunk)
+                    digest.update(chunk)
+                    out.write(chunk)
+        return {"size": size, "mtime_ns": st.st_mtime_ns, "sha256": digest.hexdigest()}
+
+    def _read_report(self, id: int) -> dict:
+        """Read a report file or its archived copy, the database must be locked"""
+        try:
+            with open(f"{self.db_path}/{self.FILE_REPORT.format(id)}", "r") as fp:
+                return load(fp)
+        except FileNotFoundError:
+            return self._read_archived_report(id)
+
+    def _load_report_body(self, id: int) -> dict:
+        """Read a report file, used by Report to load its message"""
+        self._lock()
+        try:
+            return self._read_report(id)
+        finally:
+            self._unlock()
 
     def get_report(self, id: int) -> Report:
         """Get Report from id. May raise KeyError if such report doesn't exist"""
         self._lock()
         try:
-            fp = open(f"{self.db_path}/report_{id}.json", "r")
-        except FileNotFoundError:
-            raise KeyError
-        report_dict = load(fp)
-        fp.close()
-        self._unlock()
-        return Report(id, report_dict["type"], report_dict["status"],
-                      report_dict["date"], report_dict["msg"])
-
-    def add_report(self, type, msg: str) -> int:
-        """Add an anonymous report, returns its ID"""
-        id = self._get_next_report_id()
-        self._lock()
-        with open(f"{self.db_path}/report_{id}.json", "w") as fp:
-            dump({
+            report = self._refresh().catalog.get(id)
+        except KeyError:
+            # Archived reports are read whole at once
+            report_dict = self._read_archived_report(id)
+            return Report(id, ReportType(report_dict["type"]), ReportStatus(report_dict["status"]),
+                          report_dict["date"], report_dict["msg"],
+                          attachments=attachments_from_list(report_dict.get("attachments", [])))
+        finally:
+            self._unlock()
+        report._loader = self._load_report_body
+        return report
+
+    def add_report(self, type, msg: str, attachments: Optional[List[Attachment]] = None) -> int:
+        """Add an anonymous report, its attachments must be in the blob store already, returns its ID"""
+        self._lock()
+        try:
+            # The ID is taken under the same lock, so concurrent writers never share it
+            id = self._max_report_id() + 1
+            date = time()
+            self._write_json(self.FILE_REPORT.format(id), {
                 "type": type,
                 "status": ReportStatus.UNSEEN,
-                "date": time(),
-                "msg": msg
-            }, fp)
-        self._unlock()
-        reports = self.list_reports()
-        reports.append(id)
-        self._overwrite_reports_index(reports)
+                "date": date,
+                "msg": msg,
+                "attachments": attachments or []
+            })
+            self._log("add", id, type, date)
+        finally:
+            self._unlock()
         return id
 
-    def _overwrite_reports_index(self, reports):
-        self._lock()
-        with open(f"{self.db_path}/{self.FILE_REPORTS_INDEX}", "w") as fp:
-            dump(reports, fp)
-        self._unlock()
+    def _refresh(self) -> DBIndex:
+        """Get the index with all changes made by this and other processes, the database must be locked"""
+        path = f"{self.db_path}/{self.FILE_INDEX}"
+        try:
+            st = stat(path)
+            index_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            index_stat = None
+        if index_stat != self._index_stat:
+            self._index = DBIndex.read(path) if index_stat is not None else DBIndex()
+            self._index_stat, self._log_offset, self._log_records = index_stat, 0, 0
+        elif index_stat is None and self._log_offset == 0 and self._has_old_files():
+            self._convert_old_files()
+            return self._refresh()
+        log_path = f"{self.db_path}/{self.FILE_INDEX_LOG.format(self._index.generation)}"
+        try:
+            log_size = stat(log_path).st_size
+        except FileNotFoundError:
+            log_size = 0
+        if log_size > self._log_offset:
+            with open(log_path, "rb") as fp:
+                fp.seek(self._log_offset)
+                used, records = self._index.replay(fp.read())
+            self._log_offset += used
+            self._log_records += records
+        return self._index
 
-    def list_reports(self) -> List[int]:
-        """List all reports"""
-        self._lock()
+    def _log(self, *record):
+        """Apply a change and append it to the log, the index must be refreshed under the same lock"""
+        self._index.apply(list(record))
+        log_path = f"{self.db_path}/{self.FILE_INDEX_LOG.format(self._index.generation)}"
+        with open(log_path, "ab") as fp:
+            # An incomplete record of a crashed writer is cut off
+            fp.truncate(self._log_offset)
+            data = DBIndex.log_record(*record)
+            fp.write(data)
+        self._log_offset += len(data)
+        self._log_records += 1
+        if self._log_records >= self.COMPACT_AFTER:
+            self._compact()
+
+    def _compact(self):
+        """Write the snapshot of the index of the next generation and remove the log, the database must be locked"""
+        index = self._index
+        old_log = self.FILE_INDEX_LOG.format(index.generation)
+        index.generation += 1
+        path = f"{self.db_path}/{self.FILE_INDEX}"
+        with open(f"{path}.tmp", "wb") as fp:
+            index.write(fp)
+        self._preserve(self.FILE_INDEX)
+        replace(f"{path}.tmp", path)
+        if exists(f"{self.db_path}/{old_log}"):
+            self._remove_file(old_log)
+        st = stat(path)
+        self._index_stat, self._log_offset, self._log_records = (st.st_ino, st.st_mtime_ns, st.st_size), 0, 0
+
+    def _has_old_files(self) -> bool:
+        return exists(f"{self.db_path}/{self.FILE_REPORTS_INDEX}") or \
+            exists(f"{self.db_path}/{self.FILE_SUBSCRIBERS}")
+
+    def _convert_old_files(self):
+        """Make the index from JSON files of old databases, the database must be locked"""
+        index = self._index
         try:
             with open(f"{self.db_path}/{self.FILE_REPORTS_INDEX}", "r") as fp:
-                reports = load(fp)
+                reports_index = load(fp)
+        except FileNotFoundError:
+            reports_index = []
+        # Old databases keep only IDs of reports in the index
+        for id in sorted(reports_index):
+            report_dict = self._read_report(id)
+            index.catalog.append(id, report_dict["type"], report_dict["status"], report_dict["date"])
+        try:
+            with open(f"{self.db_path}/{self.FILE_SUBSCRIBERS}", "r") as fp:
+                subscribers = load(fp)
         except FileNotFoundError:
+            subscribers = []
+        # Languages of old subscribers are unknown
+        for tg_id in subscribers:
+            index.subscribers.add(tg_id, NO_LANGUAGE)
+        self._compact()
+        for name in (self.FILE_REPORTS_INDEX, self.FILE_SUBSCRIBERS):
+            if exists(f"{self.db_path}/{name}"):
+                self._remove_file(name)
+
+    def select_reports(self, status: Optional[ReportStatus] = None, type: Optional[ReportType] = None,
+                       since: Optional[float] = None, until: Optional[float] = None) -> List[int]:
+        """List reports filtered by status, type and date range [since, until)"""
+        self._lock()
+        try:
+            return self._refresh().catalog.select(status, type, since, until)
+        finally:
             self._unlock()
-            return []
-        self._unlock()
-        return reports
+
+    def list_reports(self) -> List[int]:
+        """List all reports"""
+        return self.select_reports()
 
     def list_seen_reports(self) -> List[int]:
         """List seen reports"""
-        reports = self.list_reports()
-        i = 0
-        while True:
-            status = self.get_report(reports[i]).status
-            if status != ReportStatus.SEEN:
-                del reports[i]
-            else:
-                i += 1
-            if i >= len(reports):
-                break
-        return reports
+        return self.select_reports(status=ReportStatus.SEEN)
 
     def list_unseen_reports(self) -> List[int]:
         """List unseen reports"""
-        reports = self.list_reports()
-        i = 0
-        while True:
-            status = self.get_report(reports[i]).status
-            if status != ReportStatus.UNSEEN:
-                del reports[i]
-            else:
-                i += 1
-            if i >= len(reports):
-                break
-        return reports
+        return self.select_reports(status=ReportStatus.UNSEEN)
+
+    def adjacent_report(self, report_id: int, status: ReportStatus, step: int) -> Optional[int]:
+        """ID of the next (step > 0) or previous (step < 0) report with the status, None if there is no such"""
+        self._lock()
+        try:
+            return self._refresh().catalog.adjacent(report_id, status, step)
+        finally:
+            self._unlock()
+
+    def last_report(self, status: ReportStatus) -> Optional[int]:
+        """ID of the latest report with the status"""
+        return self.adjacent_report(self.max_report_id() + 1, status, -1)
+
+    def adjacent_archived_report(self, report_id: int, step: int) -> Optional[int]:
+        """ID of the next (step > 0) or previous (step < 0) archived report, None if there is no such"""
+        self._lock()
+        try:
+            return self._load_archive().adjacent(report_id, step)
+        finally:
+            self._unlock()
+
+    def last_archived_report(self) -> Optional[int]:
+        """ID of the latest archived report"""
+        return self.adjacent_archived_report(self.max_report_id() + 1, -1)
+
+    def put_blob(self, data: bytes) -> str:
+        """Save a photo or a video, returns its blob ID, the same content is saved only once"""
+        blob_id = sha256(data).hexdigest()
+        path = f"{self.db_path}/{self.FILE_BLOB.format(blob_id)}"
+        if exists(path):
+            return blob_id
+        try:
+            mkdir(f"{self.db_path}/{self.DIR_BLOBS}")
+        except FileExistsError:
+            pass
+        # Blobs are written without the lock, a unique temporary file is enough for concurrent writers
+        fd, tmp_path = mkstemp(suffix=".tmp", dir=f"{self.db_path}/{self.DIR_BLOBS}")
+        with fdopen(fd, "wb") as fp:
+            fp.write(data)
+        replace(tmp_path, path)
+        return blob_id
+
+    def open_blob(self, blob_id: str) -> BinaryIO:
+        """Open a blob for reading, may raise FileNotFoundError"""
+        return open(f"{self.db_path}/{self.FILE_BLOB.format(blob_id)}", "rb")
+
+    def _list_blobs(self) -> List[str]:
+        try:
+            return [name for name in listdir(f"{self.db_path}/{self.DIR_BLOBS}") if not name.endswith(".tmp")]
+        except FileNotFoundError:
+            return []
+
+    def get_blob_file_id(self, blob_id: str) -> Optional[str]:
+        """Get Telegram file_id of a blob, None if it wasn't sent or received yet"""
+        self._lock()
+        try:
+            return self._refresh().file_ids.get(blob_id)
+        finally:
+            self._unlock()
+
+    def get_blob_by_unique_id(self, unique_id: str) -> Optional[str]:
+        """Get the blob ID of a Telegram file by its file_unique_id, None if the file wasn't received yet"""
+        self._lock()
+        try:
+            return self._refresh().unique_ids.get(unique_id)
+        finally:
+            self._unlock()
+
+    def set_blob_file_id(self, blob_id: str, file_id: str, unique_id: Optional[str] = None):
+        """Remember Telegram file_id of a blob and file_unique_id of the received file"""
+        self._lock()
+        try:
+            index = self._refresh()
+            if index.file_ids.get(blob_id) != file_id or \
+                    (unique_id is not None and index.unique_ids.get(unique_id) != blob_id):
+                self._log("file_id", blob_id, file_id, unique_id)
+        finally:
+            self._unlock()
+
+    def _load_archive(self) -> ArchiveIndex:
+        """Get the index of archived reports with segments added by other processes, the database must be locked"""
+        try:
+            size = stat(f"{self.db_path}/{self.FILE_ARCHIVE_INDEX}").st_size
+        except FileNotFoundError:
+            size = 0
+        if size < self._archive_offset:
+            # The database was replaced, e.g. restored from a snapshot
+            self._archive, self._archive_offset = ArchiveIndex(), 0
+        if size - self._archive_offset >= ArchiveIndex.RECORD.size:
+            with open(f"{self.db_path}/{self.FILE_ARCHIVE_INDEX}", "rb") as fp:
+                fp.seek(self._archive_offset)
+                records = ArchiveIndex.records(fp.read(size - self._archive_offset))
+            for segment, count, _, _ in records:
+                with open(f"{self.db_path}/{self.FILE_ARCHIVE_IDS.format(segment)}", "rb") as fp:
+                    self._archive.add(segment, _native_array("Q", fp.read(8 * count)))
+            self._archive_offset += len(records) * ArchiveIndex.RECORD.size
+        return self._archive
+
+    def _append_archive(self, segment: int, ids: List[int]):
+        """Write IDs of a new segment and append it to the archive index, the database must be locked"""
+        ids = array("Q", sorted(ids))
+        path = f"{self.db_path}/{self.FILE_ARCHIVE_IDS.format(segment)}"
+        with open(f"{path}.tmp", "wb") as fp:
+            fp.write(_little_endian_bytes(ids))
+        replace(f"{path}.tmp", path)
+        archive = self._load_archive()
+        with open(f"{self.db_path}/{self.FILE_ARCHIVE_INDEX}", "ab") as fp:
+            # An incomplete record of a crashed writer is cut off
+            fp.truncate(self._archive_offset)
+            fp.write(ArchiveIndex.RECORD.pack(segment, len(ids), ids[0], ids[-1]))
+        archive.add(segment, ids)
+        self._archive_offset += ArchiveIndex.RECORD.size
+
+    def _open_segment(self, segment: int) -> ZipFile:
+        """Get an open archive segment, the database must be locked"""
+        if segment not in self._open_segments:
+            if len(self._open_segments) >= self.OPEN_SEGMENTS:
+                oldest = next(iter(self._open_segments))
+                self._open_segments.pop(oldest).close()
+            self._open_segments[segment] = ZipFile(f"{self.db_path}/{self.FILE_ARCHIVE_SEGMENT.format(segment)}")
+        return self._open_segments[segment]
+
+    def _read_archived_report(self, id: int) -> dict:
+        """Read a report from the archive, raises KeyError if it's not there. The database must be locked"""
+        segment = self._load_archive().segment_of(id)
+        return loads(self._open_segment(segment).read(self.FILE_REPORT.format(id)))
+
+    def archive_reports(self, max_age: float) -> int:
+        """Move REMOVED reports and SEEN reports older than max_age seconds to compressed archive segments.
+
+        Segments are written without locking the database, returns the number of archived reports.
+        """
+        self._lock()
+        try:
+            catalog = self._refresh().catalog
+            ids = sorted(catalog.select(ReportStatus.REMOVED) +
+                         catalog.select(ReportStatus.SEEN, until=time() - max_age))
+            segment = self._load_archive().next_segment
+        finally:
+            self._unlock()
+        archived = 0
+        for i in range(0, len(ids), self.ARCHIVE_SEGMENT_SIZE):
+            archived += self._archive_segment(ids[i:i + self.ARCHIVE_SEGMENT_SIZE], segment)
+            segment += 1
+        return archived
+
+    def _archive_segment(self, ids: List[int], segment: int) -> int:
+        """Write reports to a new segment, then move them out of the hot index"""
+        path = f"{self.db_path}/{self.FILE_ARCHIVE_SEGMENT.format(segment)}"
+        written = []
+        with ZipFile(f"{path}.tmp", "w", ZIP_DEFLATED) as zf:
+            for id in ids:
+                try:
+                    with open(f"{self.db_path}/{self.FILE_REPORT.format(id)}", "rb") as fp:
+                        zf.writestr(self.FILE_REPORT.format(id), fp.read())
+                except FileNotFoundError:
+                    continue
+                written.append(id)
+        self._lock()
+        try:
+            catalog = self._refresh().catalog
+            # An admin could have changed the status while the segment was written
+            moved = []
+            for id in written:
+                try:
+                    i = catalog.position(id)
+                except KeyError:
+                    continue
+                if catalog.statuses[i] in (ReportStatus.SEEN, ReportStatus.REMOVED):
+                    moved.append(id)
+            if not moved:
+                remove(f"{path}.tmp")
+                return 0
+            replace(f"{path}.tmp", path)
+            self._append_archive(segment, moved)
+            self._log("drop", moved)
+            for id in moved:
+                self._remove_file(self.FILE_REPORT.format(id))
+        finally:
+            self._unlock()
+        return len(moved)
 
     def _mark_report(self, report_id: int, status):
-        report = self.get_report(report_id)
         self._lock()
-        with open(f"{self.db_path}/report_{report_id}.json", "w") as fp:
-            dump({
-                "type": report.type,
-                "status": status,
-                "date": report.date,
-                "msg": report.msg
-            }, fp)
-        self._unlock()
+        try:
+            self._refresh().catalog.position(report_id)
+            report_dict = self._read_report(report_id)
+            report_dict["status"] = status
+            self._write_json(self.FILE_REPORT.format(report_id), report_dict)
+            self._log("status", report_id, status)
+        finally:
+            self._unlock()
 
     def mark_report_seen(self, report_id: int):
         """After an operator reads the report, he/she can mark it as seen"""
@@ -204,3 +1043,33 @@ class BotDB:
     def mark_report_removed(self, report_id: int):
         """If the report is indecent, the operator can mark it spam and delete it"""
         self._mark_report(report_id, ReportStatus.REMOVED)
+
+
+class SharedBotDB(BotDB):
+    """BotDB which can be used by several processes at once.
+
+    Besides the lock between threads, the database is locked with flock on a lock file.
+    Every process must create its own SharedBotDB, the lock file must not be inherited by fork.
+    """
+    FILE_LOCK = "db.lock"
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self._lock_fp = open(f"{self.db_path}/{self.FILE_LOCK}", "a")
+
+    def _lock(self):
+        """Lock the database for this thread and this process"""
+        # flock doesn't exclude threads sharing the file, so only the thread holding the lock takes it
+        super()._lock()
+        try:
+            flock(self._lock_fp, LOCK_EX)
+        except BaseException:
+            super()._unlock()
+            raise
+
+    def _unlock(self):
+        """Unlock the database"""
+        try:
+            flock(self._lock_fp, LOCK_UN)
+        finally:
+            super()._unlock()
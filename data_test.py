@@ -1,6 +1,9 @@
 import data
 import unittest
 import shutil
+import multiprocessing
+import threading
+import os
 
 TEMPDIR = "/tmp/TestDBDirectory"
 
@@ -27,6 +30,10 @@ class TestReportHandler(unittest.TestCase):
         self.assertGreater(report.date, 0)
         self.assertEqual(report.msg, "I hate this shop")
 
+    def test_missing_report(self):
+        id1 = self.db.add_report(data.ReportType.OTHER, "I need help!")
+        self.assertRaises(KeyError, self.db.get_report, id1 + 100)
+
     def test_mark_seen_and_unseen(self):
         self.db.mark_report_seen(0)
         self.assertEqual(len(self.db.list_seen_reports()), 1)
@@ -34,6 +41,189 @@ class TestReportHandler(unittest.TestCase):
         self.assertEqual(len(self.db.list_seen_reports()), 0)
 
 
+class TestReportCatalog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.catalog = data.ReportCatalog()
+        for i in range(1, 11):
+            self.catalog.append(i, data.ReportType.OTHER if i % 2 else data.ReportType.SHOP_OVERPRICE,
+                                data.ReportStatus.SEEN if i % 3 == 0 else data.ReportStatus.UNSEEN, 100 + i)
+
+    def test_select(self):
+        c = self.catalog
+        self.assertListEqual(c.select(), list(range(1, 11)))
+        self.assertListEqual(c.select(status=data.ReportStatus.SEEN), [3, 6, 9])
+        self.assertListEqual(c.select(status=data.ReportStatus.SEEN, type=data.ReportType.OTHER), [3, 9])
+        self.assertListEqual(c.select(since=105, until=108), [5, 6, 7])
+        self.assertListEqual(c.select(status=data.ReportStatus.REMOVED), [])
+
+    def test_adjacent(self):
+        c = self.catalog
+        self.assertEqual(c.adjacent(3, data.ReportStatus.SEEN, 1), 6)
+        self.assertEqual(c.adjacent(3, data.ReportStatus.SEEN, -1), None)
+        self.assertEqual(c.adjacent(9, data.ReportStatus.SEEN, 1), None)
+        # The current report may have another status already
+        self.assertEqual(c.adjacent(5, data.ReportStatus.SEEN, -1), 3)
+        self.assertEqual(c.adjacent(11, data.ReportStatus.UNSEEN, -1), 10)
+
+
+class TestReportsIndexMigration(unittest.TestCase):
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_old_index(self):
+        db = data.BotDB(TEMPDIR)
+        for id in (1, 2):
+            db._write_json(db.FILE_REPORT.format(id), {"type": data.ReportType.OTHER, "status": id,
+                                                       "date": 1.0, "msg": str(id)})
+        db._write_json(db.FILE_REPORTS_INDEX, [1, 2])
+        db = data.BotDB(TEMPDIR)
+        self.assertListEqual(db.list_seen_reports(), [1])
+        self.assertEqual(db.get_report(2).msg, "2")
+
+    def test_old_subscribers(self):
+        db = data.BotDB(TEMPDIR)
+        db._write_json(db.FILE_SUBSCRIBERS, [5, 3])
+        db = data.BotDB(TEMPDIR)
+        self.assertDictEqual(db.list_subscriber_segments(), {data.NO_LANGUAGE: [3, 5]})
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = data.BotDB(TEMPDIR)
+        self.ids = [self.db.add_report(data.ReportType(i % 2 * 9), str(i)) for i in range(4)]
+        self.db.mark_report_seen(self.ids[1])
+        self.db.subscribe_user(7, "ru")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def check(self, db):
+        self.assertListEqual(db.list_reports(), self.ids)
+        self.assertListEqual(db.list_seen_reports(), [self.ids[1]])
+        self.assertListEqual(db.select_reports(type=data.ReportType.OTHER), [self.ids[1], self.ids[3]])
+        self.assertDictEqual(db.list_subscriber_segments(), {"ru": [7]})
+
+    def test_log_replay(self):
+        self.check(data.BotDB(TEMPDIR))
+
+    def test_compaction(self):
+        self.db._compact()
+        self.assertEqual(self.db.load(), 4)
+        db = data.BotDB(TEMPDIR)
+        self.check(db)
+        # Changes after compaction go to the log of the next generation
+        db.mark_report_removed(self.ids[0])
+        self.assertListEqual(self.db.select_reports(status=data.ReportStatus.REMOVED), [self.ids[0]])
+
+    def test_auto_compaction(self):
+        self.db.COMPACT_AFTER = 3
+        self.db.subscribe_user(8, "en")
+        self.db.unsubscribe_user(8)
+        self.check(data.BotDB(TEMPDIR))
+        # The log was compacted on the first change, the second one is in the new log
+        self.assertEqual(self.db._index.generation, 1)
+
+    def test_incomplete_record(self):
+        with open(f"{TEMPDIR}/{self.db.FILE_INDEX_LOG.format(0)}", "ab") as fp:
+            fp.write(b'["subscribe",9,')
+        db = data.BotDB(TEMPDIR)
+        self.check(db)
+        # The incomplete record is replaced by the next one
+        db.subscribe_user(9, "kk")
+        self.assertDictEqual(data.BotDB(TEMPDIR).list_subscriber_segments(), {"ru": [7], "kk": [9]})
+
+    def test_damaged_record(self):
+        path = f"{TEMPDIR}/{self.db.FILE_INDEX_LOG.format(0)}"
+        with open(path, "rb") as fp:
+            lines = fp.read().splitlines(keepends=True)
+        # The record which marks a report seen is damaged, the reports are added before it
+        lines[4] = b"\0" * (len(lines[4]) - 1) + b"\n"
+        with open(path, "wb") as fp:
+            fp.write(b"".join(lines))
+        with self.assertLogs(data.logger, "WARNING"):
+            db = data.BotDB(TEMPDIR)
+            self.assertListEqual(db.list_reports(), self.ids)
+        self.assertListEqual(db.list_seen_reports(), [])
+        self.assertDictEqual(db.list_subscriber_segments(), {})
+        # The next write replaces the damaged part of the log
+        db.subscribe_user(9, "kk")
+        self.assertDictEqual(data.BotDB(TEMPDIR).list_subscriber_segments(), {"kk": [9]})
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = data.BotDB(TEMPDIR)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_archive_reports(self):
+        db = self.db
+        ids = [db.add_report(data.ReportType.OTHER, f"report {i}") for i in range(6)]
+        db.mark_report_seen(ids[0])
+        db.mark_report_seen(ids[1])
+        db.mark_report_removed(ids[2])
+        # Only REMOVED reports are old enough when max_age is large
+        self.assertEqual(db.archive_reports(3600), 1)
+        self.assertEqual(db.archive_reports(0), 2)
+        self.assertEqual(db.archive_reports(0), 0)
+        self.assertListEqual(db.list_reports(), ids[3:])
+        self.assertListEqual(db.list_seen_reports(), [])
+        # Archived reports are still readable
+        report = db.get_report(ids[1])
+        self.assertEqual(report.status, data.ReportStatus.SEEN)
+        self.assertEqual(report.msg, "report 1")
+        self.assertEqual(data.BotDB(TEMPDIR).get_report(ids[2]).msg, "report 2")
+        self.assertRaises(KeyError, db.get_report, ids[-1] + 1)
+
+    def test_browse_archive(self):
+        db = self.db
+        self.assertIsNone(db.last_archived_report())
+        ids = [db.add_report(data.ReportType.OTHER, str(i)) for i in range(4)]
+        db.mark_report_seen(ids[0])
+        db.mark_report_removed(ids[2])
+        db.archive_reports(0)
+        self.assertEqual(db.last_archived_report(), ids[2])
+        self.assertEqual(db.adjacent_archived_report(ids[2], -1), ids[0])
+        self.assertIsNone(db.adjacent_archived_report(ids[0], -1))
+        self.assertEqual(db.adjacent_archived_report(ids[0], 1), ids[2])
+        self.assertIsNone(db.adjacent_archived_report(ids[2], 1))
+        # Archived reports can't be marked
+        self.assertRaises(KeyError, db.mark_report_unseen, ids[0])
+
+    def test_ids_are_not_reused(self):
+        db = self.db
+        id = db.add_report(data.ReportType.OTHER, "last")
+        db.mark_report_removed(id)
+        db.archive_reports(0)
+        self.assertEqual(db.add_report(data.ReportType.OTHER, "new"), id + 1)
+
+    def test_segments(self):
+        db = self.db
+        # More segments than are kept open
+        db.ARCHIVE_SEGMENT_SIZE = 1
+        ids = [db.add_report(data.ReportType.OTHER, str(i)) for i in range(5)]
+        for id in ids:
+            db.mark_report_removed(id)
+        self.assertEqual(db.archive_reports(0), 5)
+        self.assertListEqual([db.get_report(id).msg for id in ids], [str(i) for i in range(5)])
+
+    def test_index_is_appended(self):
+        db = self.db
+        other = data.BotDB(TEMPDIR)
+        ids = [db.add_report(data.ReportType.OTHER, str(i)) for i in range(4)]
+        db.mark_report_removed(ids[0])
+        db.archive_reports(0)
+        self.assertEqual(other.get_report(ids[0]).msg, "0")
+        db.mark_report_removed(ids[2])
+        db.archive_reports(0)
+        # One record per segment, the other database reads only the new one
+        self.assertEqual(os.path.getsize(f"{TEMPDIR}/{db.FILE_ARCHIVE_INDEX}"), 2 * data.ArchiveIndex.RECORD.size)
+        self.assertEqual(other.get_report(ids[2]).msg, "2")
+        self.assertEqual(other.last_archived_report(), ids[2])
+        self.assertEqual(other.max_report_id(), ids[3])
+
+
 class TestSubscriptionHandler(unittest.TestCase):
     def setUp(self) -> None:
         self.db = data.BotDB(TEMPDIR)
@@ -62,3 +252,100 @@ class TestSubscriptionHandler(unittest.TestCase):
         for i in range(len(self.expected_list)):
             db.unsubscribe_user(self.expected_list[i])
             self.assertListEqual(db.list_subscribers(), self.expected_list[i + 1:])
+
+    def test_language_segments(self):
+        db = self.db
+        db.subscribe_user(1, "en")
+        db.subscribe_user(2, "ru")
+        db.subscribe_user(3)
+        self.assertDictEqual(db.list_subscriber_segments(),
+                             {"en": [1], "ru": [2], data.NO_LANGUAGE: [3]})
+        self.assertEqual(db.get_subscriber_language(2), "ru")
+        # Subscribing again with another language moves the user
+        db.subscribe_user(2, "kk")
+        self.assertDictEqual(db.list_subscriber_segments(),
+                             {"en": [1], "kk": [2], data.NO_LANGUAGE: [3]})
+        for i in range(1, 4):
+            db.unsubscribe_user(i)
+        self.assertDictEqual(db.list_subscriber_segments(), {})
+
+
+class TestBlobs(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = data.BotDB(TEMPDIR)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(TEMPDIR)
+
+    def test_deduplication(self):
+        blob_id = self.db.put_blob(b"flood")
+        self.assertEqual(self.db.put_blob(b"flood"), blob_id)
+        self.assertNotEqual(self.db.put_blob(b"other"), blob_id)
+        self.assertEqual(len(os.listdir(f"{TEMPDIR}/{data.BotDB.DIR_BLOBS}")), 2)
+        with self.db.open_blob(blob_id) as fp:
+            self.assertEqual(fp.read(), b"flood")
+
+    def test_file_ids(self):
+        blob_id = self.db.put_blob(b"photo")
+        self.assertIsNone(self.db.get_blob_file_id(blob_id))
+        self.assertIsNone(self.db.get_blob_by_unique_id("unique"))
+        self.db.set_blob_file_id(blob_id, "AgAD", "unique")
+        db = data.BotDB(TEMPDIR)
+        self.assertEqual(db.get_blob_file_id(blob_id), "AgAD")
+        self.assertEqual(db.get_blob_by_unique_id("unique"), blob_id)
+        # file_ids are kept in the index snapshot too
+        db._compact()
+        db.set_blob_file_id(blob_id, "AgAE")
+        db = data.BotDB(TEMPDIR)
+        self.assertEqual(db.get_blob_file_id(blob_id), "AgAE")
+        self.assertEqual(db.get_blob_by_unique_id("unique"), blob_id)
+
+    def test_report_attachments(self):
+        attachments = [(data.AttachmentType.PHOTO, self.db.put_blob(b"photo")),
+                       (data.AttachmentType.VIDEO, self.db.put_blob(b"video"))]
+        id = self.db.add_report(data.ReportType.OTHER, "", attachments)
+        old_id = self.db.add_report(data.ReportType.OTHER, "text only")
+        self.assertListEqual(self.db.get_report(id).attachments, attachments)
+        self.assertListEqual(self.db.get_report(old_id).attachments, [])
+        self.db.mark_report_removed(id)
+        self.db.archive_reports(0)
+        self.assertListEqual(self.db.get_report(id).attachments, attachments)
+
+
+SHARED_TEMPDIR = "/tmp/TestSharedDBDirectory"
+
+
+def add_reports(count):
+    db = data.SharedBotDB(SHARED_TEMPDIR)
+    for i in range(count):
+        db.add_report(data.ReportType.OTHER, str(i))
+
+
+class TestSharedDB(unittest.TestCase):
+    def tearDown(self) -> None:
+        shutil.rmtree(SHARED_TEMPDIR)
+
+    def test_concurrent_add_report(self):
+        data.SharedBotDB(SHARED_TEMPDIR)
+        processes = [multiprocessing.Process(target=add_reports, args=(20,)) for _ in range(4)]
+        [p.start() for p in processes]
+        [p.join() for p in processes]
+        reports = data.SharedBotDB(SHARED_TEMPDIR).list_reports()
+        self.assertListEqual(reports, list(range(1, 81)))
+
+    def test_concurrent_threads(self):
+        db = data.SharedBotDB(SHARED_TEMPDIR)
+        ids = []
+
+        def write(thread):
+            for i in range(50):
+                ids.append(db.add_report(data.ReportType.OTHER, str(i)))
+                db.subscribe_user(thread * 100 + i, str(i % 3))
+
+        threads = [threading.Thread(target=write, args=(t,)) for t in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertListEqual(sorted(ids), list(range(1, 401)))
+        fresh = data.BotDB(SHARED_TEMPDIR)
+        self.assertListEqual(fresh.list_reports(), list(range(1, 401)))
+        self.assertEqual(len(fresh.list_subscribers()), 400)
@@ -0,0 +1,242 @@
+"""Scheduler of outbound requests to Telegram.
+
+All replies and broadcasts go through one OutboundScheduler, so they share Telegram
+limits: about 30 messages per second in total and about one message per second in a chat.
+Interactive replies go first, then messages for admins, then broadcasts,
+so users don't wait behind a big news publication.
+Requests of one chat are never sent concurrently and keep their order inside a priority class,
+but not across classes: a reply can overtake a broadcast to the same chat.
+Several processes can share the total limit through a SharedTokenBucket.
+"""
+from typing import Dict, List, Callable, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic
+import threading
+import logging
+import telegram as tg
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower is sent earlier
+INTERACTIVE, ADMIN, BROADCAST = range(3)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self, now: float):
+        # A shared bucket can be refilled by another process a moment later
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float, reserve: float = 0) -> float:
+        """Seconds until a token is available, reserve tokens are left in the bucket"""
+        self._refill(now)
+        needed = 1 + reserve
+        return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket in shared memory, so processes have one limit.
+
+    The state and the lock are made once by make_state and passed to the processes,
+    monotonic() is the same clock in all processes of the system.
+    """
+
+    def __init__(self, rate: float, capacity: float, state, lock):
+        # The state is not reset, other processes may use it already
+        self.rate = rate
+        self.capacity = capacity
+        self._state = state
+        self._process_lock = lock
+
+    @staticmethod
+    def make_state(context, capacity: float):
+        """Make the shared state and lock by a multiprocessing context"""
+        return context.RawArray("d", [capacity, monotonic()]), context.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._state[0]
+
+    @tokens.setter
+    def tokens(self, value: float):
+        self._state[0] = value
+
+    @property
+    def updated(self) -> float:
+        return self._state[1]
+
+    @updated.setter
+    def updated(self, value: float):
+        self._state[1] = value
+
+    def delay(self, now: float, reserve: float = 0) -> float:
+        with self._process_lock:
+            return super().delay(now, reserve)
+
+    def take(self, now: float):
+        with self._process_lock:
+            super().take(now)
+
+
+class _Job:
+    __slots__ = ("chat_id", "priority", "fn", "args", "kwargs", "future")
+
+    def __init__(self, chat_id: int, priority: int, fn: Callable, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class OutboundScheduler:
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: int = 3,
+                 threads: int = 8, max_broadcast_pending: int = 1000,
+                 bucket: Optional[TokenBucket] = None, broadcast_reserve: float = 0):
+        """bucket is the total limit shared with other processes, by default it's rate messages per second.
+        Broadcasts leave broadcast_reserve tokens in it for replies of other processes.
+        """
+        self._bucket = bucket if bucket is not None else TokenBucket(rate, rate)
+        self._broadcast_reserve = broadcast_reserve
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # Chat ID -> its jobs in order, one OrderedDict per priority class, chats are served round-robin
+        self._queues: List[OrderedDict] = [OrderedDict() for _ in range(BROADCAST + 1)]
+        self._pending = [0] * (BROADCAST + 1)
+        # Chats which have a request being sent now, one request per chat
+        self._in_flight = set()
+        # A job is taken only when a thread is free, so a later reply isn't queued behind broadcasts
+        self._threads = threads
+        self._paused_until = 0.0
+        self._max_broadcast_pending = max_broadcast_pending
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="sender")
+        self._thread = threading.Thread(target=self._run, name="outbound_scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, priority: int, chat_id: int, fn: Callable, *args, **kwargs) -> Future:
+        """Schedule fn(*args, **kwargs) which sends to the chat, returns Future of its result.
+
+        Broadcasts block while too many of them are pending, so a big publication doesn't take all memory.
+        """
+        job = _Job(chat_id, priority, fn, args, kwargs)
+        with self._condition:
+            if priority == BROADCAST:
+                self._condition.wait_for(lambda: self._pending[BROADCAST] < self._max_broadcast_pending)
+            self._queues[priority].setdefault(chat_id, deque()).append(job)
+            self._pending[priority] += 1
+            self._condition.notify_all()
+        return job.future
+
+    def pending(self, priority: int) -> int:
+        """Number of jobs of the class which are not sent yet"""
+        with self._condition:
+            return self._pending[priority]
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _forget_idle_chats(self, now: float):
+        """Drop buckets of chats which can send a burst again, they are the same as new buckets"""
+        idle = [chat_id for chat_id, bucket in self._chat_buckets.items()
+                if chat_id not in self._in_flight and bucket.is_full(now)]
+        for chat_id in idle:
+            del self._chat_buckets[chat_id]
+
+    def _next_job(self) -> _Job:
+        """Wait for a job which can be sent now, the condition must be acquired"""
+        while True:
+            if len(self._in_flight) >= self._threads:
+                self._condition.wait()
+                continue
+            now = monotonic()
+            wait = self._paused_until - now
+            if wait <= 0:
+                wait = None
+                for priority, queue in enumerate(self._queues):
+                    if not queue:
+                        continue
+                    bucket_wait = self._bucket.delay(now, self._broadcast_reserve if priority == BROADCAST else 0)
+                    if bucket_wait > 0:
+                        wait = bucket_wait if wait is None else min(wait, bucket_wait)
+                        break
+                    # Only chats that were sent to during the last seconds are skipped here
+                    for chat_id, jobs in queue.items():
+                        if chat_id in self._in_flight:
+                            continue
+                        chat_wait = self._chat_bucket(chat_id).delay(now)
+                        if chat_wait > 0:
+                            wait = chat_wait if wait is None else min(wait, chat_wait)
+                            continue
+                        job = jobs.popleft()
+                        if jobs:
+                            queue.move_to_end(chat_id)
+                        else:
+                            del queue[chat_id]
+                        return job
+            self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                now = monotonic()
+                self._bucket.take(now)
+                self._chat_bucket(job.chat_id).take(now)
+                self._in_flight.add(job.chat_id)
+                if len(self._chat_buckets) > 10000:
+                    self._forget_idle_chats(now)
+            try:
+                self._executor.submit(self._send, job)
+            except RuntimeError:
+                # The interpreter is shutting down, the rest is not sent
+                return
+
+    def _send(self, job: _Job):
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except tg.error.RetryAfter as e:
+            # Telegram asks to wait, the job is sent again first of its chat
+            logger.warning(f"Flood limit exceeded, sending is paused for {e.retry_after} seconds")
+            with self._condition:
+                self._paused_until = max(self._paused_until, monotonic() + e.retry_after)
+                queue = self._queues[job.priority]
+                queue.setdefault(job.chat_id, deque()).appendleft(job)
+                queue.move_to_end(job.chat_id, last=False)
+                self._in_flight.discard(job.chat_id)
+                self._condition.notify_all()
+            return
+        except Exception as e:
+            logger.warning(f"Sending to {job.chat_id} failed: {e}")
+            self._done(job)
+            job.future.set_exception(e)
+            return
+        self._done(job)
+        job.future.set_result(result)
+
+    def _done(self, job: _Job):
+        with self._condition:
+            self._in_flight.discard(job.chat_id)
+            self._pending[job.priority] -= 1
+            self._condition.notify_all()
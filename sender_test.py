@@ -0,0 +1,102 @@
+import sender
+import unittest
+import threading
+import multiprocessing
+import time
+import telegram as tg
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestOutboundScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def record(self, item):
+        with self.lock:
+            self.sent.append(item)
+        return item
+
+    def test_chat_order(self):
+        s = sender.OutboundScheduler(rate=1000, chat_rate=1000, chat_burst=1000)
+        futures = [s.submit(sender.INTERACTIVE, 1, self.record, i) for i in range(50)]
+        [f.result(5) for f in futures]
+        self.assertListEqual(self.sent, list(range(50)))
+
+    def test_interactive_before_broadcast(self):
+        rate = 20
+        s = sender.OutboundScheduler(rate=rate)
+        broadcast = [s.submit(sender.BROADCAST, chat_id, self.record, ("broadcast", chat_id))
+                     for chat_id in range(100)]
+        interactive = s.submit(sender.INTERACTIVE, 1000, self.record, ("interactive", 1000))
+        interactive.result(5)
+        # Only the initial burst of the bucket and the jobs already in flight went before
+        self.assertLess(self.sent.index(("interactive", 1000)), rate + 10)
+        self.assertGreater(s.pending(sender.BROADCAST), 0)
+
+    def test_chat_rate(self):
+        s = sender.OutboundScheduler(rate=1000, chat_rate=10, chat_burst=1)
+        futures = [s.submit(sender.BROADCAST, 1, self.record, i) for i in range(5)]
+        futures.append(s.submit(sender.BROADCAST, 2, self.record, "other chat"))
+        futures[-1].result(5)
+        # The other chat is not blocked by the limit of the first one
+        self.assertLess(len(self.sent), 5)
+        [f.result(5) for f in futures]
+
+    def test_retry_after(self):
+        s = sender.OutboundScheduler(rate=1000)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise tg.error.RetryAfter(0.1)
+            return "sent"
+
+        self.assertEqual(s.submit(sender.ADMIN, 1, flaky).result(5), "sent")
+        self.assertEqual(len(calls), 2)
+
+    def test_error(self):
+        s = sender.OutboundScheduler(rate=1000)
+
+        def blocked():
+            raise tg.error.Unauthorized("Forbidden: bot was blocked by the user")
+
+        self.assertRaises(tg.error.Unauthorized, s.submit(sender.BROADCAST, 1, blocked).result, 5)
+        self.assertEqual(s.pending(sender.BROADCAST), 0)
+
+    def test_shared_bucket(self):
+        state, lock = sender.SharedTokenBucket.make_state(multiprocessing.get_context("spawn"), 10)
+        broadcaster = sender.OutboundScheduler(
+            chat_rate=1000, chat_burst=1000, broadcast_reserve=5,
+            bucket=sender.SharedTokenBucket(1, 10, state, lock))
+        replier = sender.OutboundScheduler(
+            chat_rate=1000, chat_burst=1000, broadcast_reserve=5,
+            bucket=sender.SharedTokenBucket(1, 10, state, lock))
+        for chat_id in range(100):
+            broadcaster.submit(sender.BROADCAST, chat_id, self.record, chat_id)
+        time.sleep(0.5)
+        # Broadcasts take only tokens above the reserve, replies of another scheduler get the rest
+        self.assertLessEqual(len(self.sent), 6)
+        start = time.monotonic()
+        replier.submit(sender.INTERACTIVE, 1000, self.record, "reply").result(5)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLess(state[0], 5)
+
+    def test_reply_not_queued_behind_slow_jobs(self):
+        s = sender.OutboundScheduler(rate=1000, threads=2)
+
+        def slow(item):
+            time.sleep(0.3)
+            return self.record(item)
+
+        broadcast = [s.submit(sender.BROADCAST, chat_id, slow, chat_id) for chat_id in range(10)]
+        time.sleep(0.1)
+        start = time.monotonic()
+        s.submit(sender.INTERACTIVE, 1000, self.record, "reply").result(5)
+        # The reply waits for a free thread only, not for all broadcasts taken before it
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLessEqual(self.sent.index("reply"), 2)
+        [f.result(5) for f in broadcast]
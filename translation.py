@@ -36,19 +36,20 @@ class BotTranslation:
                 break
         if default_language not in self.languages:
             raise ValueError
+        # Files are read once, strings absent in a language are taken from the default one
+        self.translations = {lang: self._read(lang) for lang in self.languages}
+        default = self.translations[default_language]
+        for lang, translation in self.translations.items():
+            self.translations[lang] = {**default, **translation}
+
+    def _read(self, lang):
+        with open(f"{self.translations_path}/{lang}.json") as fp:
+            return json.load(fp)
 
     def get_string(self, lang, name):
         """Get string from name by language"""
         lang = get_language_code(lang)
-        if lang not in self.languages:
-            lang = self.default_language
-        fp = open(f"{self.translations_path}/{lang}.json")
-        translation = json.load(fp)
-        fp.close()
-        if name not in translation:
-            if lang != self.default_language:
-                return self.get_string(self.default_language, name)
-            else:
-                raise KeyError
-        else:
-            return translation[name]
+        translation = self.translations.get(lang)
+        if translation is None:
+            translation = self.translations[self.default_language]
+        return translation[name]